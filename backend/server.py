@@ -1,13 +1,42 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, Header
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import StreamingResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import os
+import json
+import time
+import asyncio
+import hashlib
+import random
+import zlib
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict
+from pydantic import BaseModel, Field, EmailStr, model_validator
+from typing import List, Optional, Dict, AsyncIterator
+from collections import deque
+from cachetools import TTLCache, LRUCache
+from bson import Binary, json_util
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for SUGGESTION_CODEC=zstd
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # optional, enables "br" in the compression middleware
+    brotli = None
+
+try:
+    import orjson
+except ImportError:  # optional, faster JSON encoding for streamed responses
+    orjson = None
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
@@ -34,8 +63,113 @@ JWT_EXPIRATION_HOURS = 24
 # Stripe setup
 stripe_api_key = os.environ.get('STRIPE_API_KEY')
 
+# Entitlement sweeper interval
+ENTITLEMENT_SWEEP_MINUTES = int(os.environ.get('ENTITLEMENT_SWEEP_MINUTES', 15))
+
+# Authenticated users are cached briefly to avoid a Mongo read per request
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', 30))
+
+# Idempotency settings
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', 120))
+
+# LLM settings
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 8))
+llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+# Model routing: each route has a primary model, a fallback and a latency SLO.
+# Both tables can be overridden with JSON in LLM_MODEL_ROUTES / LLM_ROUTING_RULES.
+DEFAULT_MODEL_ROUTES = {
+    "fast": {"model": ["gemini", "gemini-2.0-flash-lite"], "fallback": ["gemini", "gemini-2.0-flash"], "latency_slo_ms": 10000},
+    "standard": {"model": ["gemini", "gemini-2.0-flash"], "fallback": ["gemini", "gemini-2.0-flash-lite"], "latency_slo_ms": 20000},
+    "strong": {"model": ["gemini", "gemini-2.5-flash"], "fallback": ["gemini", "gemini-2.0-flash"], "latency_slo_ms": 30000},
+}
+# Rules are checked in order: follow-ups, trial users, then the suggestion type
+DEFAULT_ROUTING_RULES = {"followup": "fast", "trial": "fast", "workout": "standard", "nutrition": "strong"}
+MODEL_ROUTES = json.loads(os.environ['LLM_MODEL_ROUTES']) if os.environ.get('LLM_MODEL_ROUTES') else DEFAULT_MODEL_ROUTES
+ROUTING_RULES = json.loads(os.environ['LLM_ROUTING_RULES']) if os.environ.get('LLM_ROUTING_RULES') else DEFAULT_ROUTING_RULES
+
+# Route health: latency percentiles only use the last LLM_STATS_WINDOW_SECONDS, a share of
+# requests still probes a primary that breached its SLO, and a primary failing
+# LLM_BREAKER_FAILURES times in a row is only used as a last resort for a cooldown
+LLM_STATS_WINDOW_SECONDS = int(os.environ.get('LLM_STATS_WINDOW_SECONDS', 600))
+LLM_PRIMARY_PROBE_RATE = float(os.environ.get('LLM_PRIMARY_PROBE_RATE', 0.05))
+LLM_BREAKER_FAILURES = int(os.environ.get('LLM_BREAKER_FAILURES', 3))
+LLM_BREAKER_COOLDOWN_SECONDS = int(os.environ.get('LLM_BREAKER_COOLDOWN_SECONDS', 60))
+
+# Protects internal metrics endpoints; they are disabled when unset
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Suggestion storage codec: none, zlib or zstd (zstd needs the optional zstandard package)
+SUGGESTION_CODEC = os.environ.get('SUGGESTION_CODEC', 'none')
+SUGGESTION_CODEC_LEVEL = int(os.environ.get('SUGGESTION_CODEC_LEVEL', 6))
+SUGGESTION_CODEC_MIGRATE = os.environ.get('SUGGESTION_CODEC_MIGRATE', 'false').lower() == 'true'
+
+# History summary layout: "documents" builds history summaries from one document per
+# suggestion, "buckets" reads them from monthly per-user bucket documents (kept in
+# sync when HISTORY_BUCKETS_ENABLED). Full suggestion text always comes from the documents.
+HISTORY_BUCKETS_ENABLED = os.environ.get('HISTORY_BUCKETS_ENABLED', 'false').lower() == 'true'
+HISTORY_READ_LAYOUT = os.environ.get('HISTORY_READ_LAYOUT', 'documents')
+HISTORY_BUCKET_MAX_ENTRIES = int(os.environ.get('HISTORY_BUCKET_MAX_ENTRIES', 50))
+
+# Suggestion collections: "split" uses workout_suggestions/nutrition_suggestions,
+# "dual" also writes the unified "suggestions" collection, "unified" writes only
+# there and reads it with a fallback to the legacy collections until migrated
+SUGGESTIONS_STORAGE = os.environ.get('SUGGESTIONS_STORAGE', 'split')
+SUGGESTIONS_LEGACY_FALLBACK = os.environ.get('SUGGESTIONS_LEGACY_FALLBACK', 'true').lower() == 'true'
+SUGGESTIONS_UNIFIED_MIGRATE = os.environ.get('SUGGESTIONS_UNIFIED_MIGRATE', 'false').lower() == 'true'
+
+# Change log used by /api/history/sync; older entries force a full resync
+HISTORY_CHANGES_TTL_DAYS = int(os.environ.get('HISTORY_CHANGES_TTL_DAYS', 30))
+
+# Response compression
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 5))
+
+# Retention: keep the newest keep_latest documents per user plus anything newer than
+# keep_days; older documents are archived compressed in "archive". Override with
+# RETENTION_POLICIES JSON.
+RETENTION_ENABLED = os.environ.get('RETENTION_ENABLED', 'false').lower() == 'true'
+RETENTION_INTERVAL_HOURS = int(os.environ.get('RETENTION_INTERVAL_HOURS', 24))
+DEFAULT_RETENTION_POLICIES = {
+    "workout_suggestions": {"keep_latest": 20, "keep_days": 90},
+    "nutrition_suggestions": {"keep_latest": 20, "keep_days": 90},
+    "suggestions": {"keep_latest": 20, "keep_days": 90},  # unified collection, applied per type
+    "feedback": {"keep_days": 365},
+}
+RETENTION_POLICIES = json.loads(os.environ['RETENTION_POLICIES']) if os.environ.get('RETENTION_POLICIES') else DEFAULT_RETENTION_POLICIES
+ARCHIVE_TTL_DAYS = int(os.environ.get('ARCHIVE_TTL_DAYS', 0))  # 0 keeps archives forever
+LLM_GENERATIONS_TTL_DAYS = int(os.environ.get('LLM_GENERATIONS_TTL_DAYS', 90))
+PREGEN_TTL_DAYS = int(os.environ.get('PREGEN_TTL_DAYS', 7))
+
+# Pre-generation settings (disabled by default)
+PREGEN_ENABLED = os.environ.get('PREGEN_ENABLED', 'false').lower() == 'true'
+PREGEN_RESERVED_SLOTS = int(os.environ.get('PREGEN_RESERVED_SLOTS', 2))  # LLM slots kept free for interactive requests
+PREGEN_ACTIVE_DAYS = int(os.environ.get('PREGEN_ACTIVE_DAYS', 14))
+PREGEN_BATCH_HOUR_UTC = int(os.environ.get('PREGEN_BATCH_HOUR_UTC', 3))
+
+# Open checkout sessions are reused for this long; Stripe keeps them valid for 24 hours
+CHECKOUT_SESSION_REUSE_MINUTES = int(os.environ.get('CHECKOUT_SESSION_REUSE_MINUTES', 60))
+
+# Feedback admission control: sliding-window limits per client IP and per email, in
+# memory and optionally shared through Mongo when several instances run
+DEFAULT_FEEDBACK_RATE_LIMITS = {
+    "ip": {"limit": 10, "window_seconds": 3600},
+    "email": {"limit": 3, "window_seconds": 3600},
+}
+FEEDBACK_RATE_LIMITS = json.loads(os.environ['FEEDBACK_RATE_LIMITS']) if os.environ.get('FEEDBACK_RATE_LIMITS') else DEFAULT_FEEDBACK_RATE_LIMITS
+FEEDBACK_RATE_STORE = os.environ.get('FEEDBACK_RATE_STORE', 'memory')  # memory | mongo
+FEEDBACK_DUPLICATE_WINDOW_SECONDS = int(os.environ.get('FEEDBACK_DUPLICATE_WINDOW_SECONDS', 86400))
+# Only enable behind proxies that append to X-Forwarded-For; TRUSTED_PROXY_HOPS is how
+# many of them sit in front of the app (the client address is that many entries from the right)
+TRUST_FORWARDED_FOR = os.environ.get('TRUST_FORWARDED_FOR', 'false').lower() == 'true'
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1))
+
 # Create the main app without a prefix
-app = FastAPI(title="FitLife AI API")
+# Responses are rendered with orjson when it is installed
+FastJSONResponse = ORJSONResponse if orjson is not None else JSONResponse
+app = FastAPI(title="FitLife AI API", default_response_class=FastJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -57,6 +191,26 @@ class User(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     is_premium: bool = False
     trial_end_date: datetime = Field(default_factory=lambda: datetime.now(timezone.utc) + timedelta(days=7))
+    access_state: Optional[str] = None  # trial, premium ou expired (materializado pelo sweeper)
+    access_until: Optional[datetime] = None  # Fim do acesso; None para premium
+    profile_version: int = 0  # Incrementado a cada alteração do perfil (ETag)
+    history_seq: int = 0  # Incrementado a cada sugestão criada ou excluída (ETag e sync)
+    
+    @model_validator(mode="after")
+    def materialize_access(self):
+        self.fill_access_fields()
+        return self
+    
+    def fill_access_fields(self):
+        """Fill access fields for new users and documents written before they existed"""
+        if self.access_state is None:
+            if self.is_premium:
+                self.access_state = "premium"
+            else:
+                self.access_state = "trial"
+                self.access_until = self.trial_end_date
+        if self.access_until is not None and self.access_until.tzinfo is None:
+            self.access_until = self.access_until.replace(tzinfo=timezone.utc)
 
 class UserCreate(BaseModel):
     email: EmailStr
@@ -88,6 +242,11 @@ class UserResponse(BaseModel):
     is_premium: bool
     trial_end_date: datetime
 
+class AuthResponse(BaseModel):
+    message: str
+    token: str
+    user: UserResponse
+
 class WorkoutSuggestion(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
@@ -100,6 +259,26 @@ class NutritionSuggestion(BaseModel):
     suggestion: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class HistoryEntry(BaseModel):
+    id: str
+    user_id: str
+    type: str  # workout ou nutrition
+    suggestion: str
+    created_at: datetime
+
+class HistorySummary(BaseModel):
+    id: str
+    type: str  # workout ou nutrition
+    title: str  # Primeira linha da sugestão
+    chars: int  # Tamanho do texto completo
+    created_at: datetime
+
+class HistorySyncResponse(BaseModel):
+    token: str  # Enviar como ?since= na próxima sincronização
+    full: bool  # True quando o cliente deve substituir o cache local
+    suggestions: List[HistoryEntry] = []
+    deleted: List[Dict[str, str]] = []  # [{"type": ..., "id": ...}]
+
 class PaymentTransaction(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
@@ -108,6 +287,9 @@ class PaymentTransaction(BaseModel):
     currency: str
     payment_status: str = "pending"
     metadata: Dict[str, str] = {}
+    url: Optional[str] = None
+    host_url: Optional[str] = None
+    expires_at: Optional[datetime] = None  # until when the checkout session is reused
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class AccountDeletionRequest(BaseModel):
@@ -123,69 +305,119 @@ class UserUpdateRequest(BaseModel):
     workout_type: Optional[str] = None
     current_activities: Optional[str] = None
 
+class FollowUpRequest(BaseModel):
+    message: str = Field(min_length=1, max_length=500)  # Ex: "deixe mais curto", "troque o jantar"
+
 class FeedbackRequest(BaseModel):
     name: str
     email: EmailStr
     message: str
     rating: Optional[int] = None  # 1-5 estrelas (opcional)
 
-# Email sending function
-async def send_feedback_email(feedback: FeedbackRequest):
-    """Send feedback email to the configured email address"""
-    try:
-        # Email configuration from environment
-        smtp_server = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
-        smtp_port = int(os.environ.get('SMTP_PORT', 587))
-        smtp_username = os.environ.get('SMTP_USERNAME')
-        smtp_password = os.environ.get('SMTP_PASSWORD')
-        feedback_email = os.environ.get('FEEDBACK_EMAIL', 'codejungle8@gmail.com')
-        
-        # Create message
-        msg = MIMEMultipart()
-        msg['From'] = smtp_username if smtp_username else 'noreply@fitlife.ai'
-        msg['To'] = feedback_email
-        msg['Subject'] = f'Feedback FitLife AI - {feedback.name}'
-        
-        # Email body
-        rating_text = f" - Avaliação: {feedback.rating}/5 ⭐" if feedback.rating else ""
-        
-        body = f"""
+# Read models
+# Documents loaded from Mongo were validated when they were written, so they are
+# turned into models with model_construct and returned through model_response,
+# which serializes once instead of letting FastAPI validate the result again.
+def user_from_doc(doc: dict) -> User:
+    user = User.model_construct(**doc)
+    user.fill_access_fields()
+    return user
+
+def user_response(user: User) -> UserResponse:
+    return UserResponse.model_construct(**user.__dict__)
+
+def model_response(model: BaseModel, headers: Optional[dict] = None) -> Response:
+    """Serialize an already valid model without validating it again"""
+    return FastJSONResponse(model.model_dump(mode="json"), headers=headers)
+
+# Email sending
+# Feedback emails are delivered by the outbox worker over one persistent SMTP
+# connection. For local testing run local_smtp_sink.py and set SMTP_SERVER=localhost,
+# SMTP_PORT=1025, SMTP_STARTTLS=false and SMTP_NO_AUTH=true.
+SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_USERNAME = os.environ.get('SMTP_USERNAME')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', 'true').lower() == 'true'
+SMTP_NO_AUTH = os.environ.get('SMTP_NO_AUTH', 'false').lower() == 'true'
+FEEDBACK_EMAIL = os.environ.get('FEEDBACK_EMAIL', 'codejungle8@gmail.com')
+
+def smtp_configured() -> bool:
+    return bool(SMTP_USERNAME and SMTP_PASSWORD) or SMTP_NO_AUTH
+
+class SmtpConnection:
+    """SMTP connection kept open between messages and reopened when it drops"""
+    def __init__(self):
+        self.client = None
+        self.lock = asyncio.Lock()
+    
+    async def connect(self):
+        self.client = aiosmtplib.SMTP(hostname=SMTP_SERVER, port=SMTP_PORT)
+        await self.client.connect(start_tls=SMTP_STARTTLS)
+        if SMTP_USERNAME and SMTP_PASSWORD:
+            await self.client.login(SMTP_USERNAME, SMTP_PASSWORD)
+    
+    async def send(self, messages: List[MIMEMultipart]):
+        """Send messages, reconnecting once if the server closed the connection"""
+        async with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.client is None or not self.client.is_connected:
+                        await self.connect()
+                    for message in messages:
+                        await self.client.send_message(message)
+                    return
+                except aiosmtplib.SMTPServerDisconnected:
+                    self.client = None
+                    if attempt:
+                        raise
+    
+    async def close(self):
+        if self.client is not None and self.client.is_connected:
+            try:
+                await self.client.quit()
+            except aiosmtplib.SMTPException:
+                pass
+        self.client = None
+
+smtp_connection = SmtpConnection()
+
+def build_feedback_message(feedback: dict) -> MIMEMultipart:
+    # Create message
+    msg = MIMEMultipart()
+    msg['From'] = SMTP_USERNAME if SMTP_USERNAME else 'noreply@fitlife.ai'
+    msg['To'] = FEEDBACK_EMAIL
+    msg['Subject'] = f'Feedback FitLife AI - {feedback["name"]}'
+    
+    # Email body
+    body = f"""
         Novo feedback recebido no FitLife AI!
         
         📝 DETALHES DO FEEDBACK:
         
-        👤 Nome: {feedback.name}
-        📧 Email: {feedback.email}
-        ⭐ Avaliação: {feedback.rating}/5 estrelas (se fornecida)
-        📅 Data: {datetime.now(timezone.utc).strftime('%d/%m/%Y às %H:%M')} UTC
+        👤 Nome: {feedback["name"]}
+        📧 Email: {feedback["email"]}
+        ⭐ Avaliação: {feedback["rating"]}/5 estrelas (se fornecida)
+        📅 Data: {feedback["created_at"].strftime('%d/%m/%Y às %H:%M')} UTC
         
         💬 MENSAGEM:
-        {feedback.message}
+        {feedback["message"]}
         
         ---
         Este email foi enviado automaticamente pelo sistema FitLife AI.
-        Para responder ao usuário, use o email: {feedback.email}
+        Para responder ao usuário, use o email: {feedback["email"]}
         """
-        
-        msg.attach(MIMEText(body, 'plain'))
-        
-        # Send email (if SMTP is configured)
-        if smtp_username and smtp_password:
-            server = aiosmtplib.SMTP(hostname=smtp_server, port=smtp_port)
-            await server.connect()
-            await server.starttls()
-            await server.login(smtp_username, smtp_password)
-            await server.send_message(msg)
-            await server.quit()
-            return True
-        else:
-            # Log the feedback instead of sending email (for development)
-            logging.info(f"Feedback received (SMTP not configured): {feedback.dict()}")
-            return True
-            
-    except Exception as e:
-        logging.error(f"Error sending feedback email: {str(e)}")
-        return False
+    
+    msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+async def send_feedback_email(feedback: dict):
+    """Send feedback email to the configured email address; raises on failure"""
+    if smtp_configured():
+        await smtp_connection.send([build_feedback_message(feedback)])
+    else:
+        # Log the feedback instead of sending email (for development)
+        logging.info(f"Feedback received (SMTP not configured): {feedback['id']} from {feedback['email']}")
 
 def format_ai_response(text: str) -> str:
     """Format AI response for better presentation"""
@@ -203,6 +435,74 @@ def format_ai_response(text: str) -> str:
     
     return '\n\n'.join(formatted_lines)
 
+# Background tasks
+background_tasks = set()
+
+def start_background_task(coro):
+    """Start a task and keep a reference to it until it finishes"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Idempotency keys
+# Completed responses are kept in Mongo (TTL index on expires_at) and in memory;
+# concurrent replays inside this process wait for the original request.
+idempotency_cache = TTLCache(maxsize=10000, ttl=IDEMPOTENCY_TTL_HOURS * 3600)
+idempotency_inflight: Dict[str, asyncio.Future] = {}
+
+async def run_idempotent(idempotency_key: Optional[str], scope: str, user_id: str, producer):
+    """Run producer once per Idempotency-Key and return the stored response for replays"""
+    if not idempotency_key:
+        return await producer()
+    if len(idempotency_key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key too long")
+    
+    key = f"{scope}:{user_id}:{idempotency_key}"
+    if key in idempotency_cache:
+        return idempotency_cache[key]
+    if key in idempotency_inflight:
+        return await asyncio.shield(idempotency_inflight[key])
+    
+    now = datetime.now(timezone.utc)
+    try:
+        await db.idempotency_keys.insert_one({
+            "key": key,
+            "status": "processing",
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+        })
+    except DuplicateKeyError:
+        stored = await db.idempotency_keys.find_one({"key": key})
+        if stored and stored["status"] == "completed":
+            idempotency_cache[key] = stored["response"]
+            return stored["response"]
+        raise HTTPException(status_code=409, detail="Requisição já em processamento. Tente novamente em instantes.")
+    
+    future = asyncio.get_running_loop().create_future()
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    idempotency_inflight[key] = future
+    try:
+        response = jsonable_encoder(await producer())
+        await db.idempotency_keys.update_one(
+            {"key": key},
+            {"$set": {
+                "status": "completed",
+                "response": response,
+                "expires_at": datetime.now(timezone.utc) + timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+            }}
+        )
+        idempotency_cache[key] = response
+        future.set_result(response)
+        return response
+    except Exception as e:
+        # Release the key so the client can retry a failed request
+        await db.idempotency_keys.delete_one({"key": key, "status": "processing"})
+        future.set_exception(e)
+        raise
+    finally:
+        idempotency_inflight.pop(key, None)
+
 # Authentication functions
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -227,53 +527,105 @@ def verify_jwt_token(token: str) -> dict:
     except jwt.JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+user_cache = TTLCache(maxsize=10000, ttl=USER_CACHE_TTL_SECONDS)
+
+def invalidate_cached_user(user_id: str):
+    user_cache.pop(user_id, None)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     payload = verify_jwt_token(credentials.credentials)
-    user = await db.users.find_one({"id": payload["user_id"]})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    return User(**user)
+    user = user_cache.get(payload["user_id"])
+    if user is None:
+        user_doc = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0, "password": 0})
+        if not user_doc:
+            raise HTTPException(status_code=404, detail="User not found")
+        user = user_from_doc(user_doc)
+        user_cache[user.id] = user
+    return user
+
+# Entitlements
+# access_state/access_until are stored on the user document, so gating is a read
+# of the (cached) user. The sweeper expires trials in bulk and backfills users
+# created before these fields existed.
+def has_access(user: User) -> bool:
+    """Check if user has access (premium or in trial)"""
+    if user.access_state == "premium":
+        return True
+    # Trials that ended since the last sweep are treated as expired already
+    return user.access_state == "trial" and (user.access_until is None or user.access_until > datetime.now(timezone.utc))
+
+async def require_access(current_user: User = Depends(get_current_user)) -> User:
+    """Dependency for routes that need an active trial or premium"""
+    if not has_access(current_user):
+        raise HTTPException(status_code=403, detail="Trial expired. Please upgrade to premium.")
+    return current_user
+
+async def grant_premium(user_id: str, session_id: str):
+    """Single place where a paid checkout turns into premium access"""
+    await db.users.update_one(
+        {"id": user_id},
+        {"$set": {"is_premium": True, "access_state": "premium", "access_until": None}, "$inc": {"profile_version": 1}}
+    )
+    invalidate_cached_user(user_id)
+    
+    # Update transaction status
+    await db.payment_transactions.update_one(
+        {"session_id": session_id},
+        {"$set": {"payment_status": "completed"}}
+    )
+
+async def sweep_entitlements():
+    now = datetime.now(timezone.utc)
+    await db.users.update_many(
+        {"access_state": {"$exists": False}, "is_premium": True},
+        {"$set": {"access_state": "premium", "access_until": None}}
+    )
+    await db.users.update_many(
+        {"access_state": {"$exists": False}},
+        [{"$set": {"access_state": "trial", "access_until": "$trial_end_date"}}]
+    )
+    result = await db.users.update_many(
+        {"access_state": "trial", "access_until": {"$lte": now}},
+        {"$set": {"access_state": "expired"}}
+    )
+    if result.modified_count:
+        logging.info(f"Entitlement sweep expired {result.modified_count} trials")
+
+async def entitlement_sweeper():
+    """Expire trials in bulk on a fixed interval"""
+    while True:
+        try:
+            await sweep_entitlements()
+        except Exception as e:
+            logging.error(f"Error sweeping entitlements: {str(e)}")
+        await asyncio.sleep(ENTITLEMENT_SWEEP_MINUTES * 60)
 
 # Authentication endpoints
-@api_router.post("/auth/register", response_model=dict)
+@api_router.post("/auth/register", response_model=AuthResponse)
 async def register_user(user_data: UserCreate):
-    # Check if user already exists
-    existing_user = await db.users.find_one({"email": user_data.email})
-    if existing_user:
+    # Create new user; the unique index on users.email rejects existing emails
+    user = User(**user_data.model_dump(exclude={"password"}))
+    user_doc = user.model_dump()
+    
+    try:
+        await db.users.insert_one({**user_doc, "password": hash_password(user_data.password)})
+    except DuplicateKeyError:
         raise HTTPException(
             status_code=400, 
             detail=f"O email {user_data.email} já está cadastrado. Tente fazer login ou use outro email."
         )
     
-    # Create new user
-    hashed_password = hash_password(user_data.password)
-    user = User(
-        email=user_data.email,
-        name=user_data.name,
-        age=user_data.age,
-        weight=user_data.weight,
-        height=user_data.height,
-        goals=user_data.goals,
-        dietary_restrictions=user_data.dietary_restrictions,
-        workout_type=user_data.workout_type,
-        current_activities=user_data.current_activities
-    )
-    
-    user_dict = user.dict()
-    user_dict["password"] = hashed_password
-    
-    await db.users.insert_one(user_dict)
-    
     # Create JWT token
-    token = create_jwt_token(user.dict())
+    token = create_jwt_token(user_doc)
     
+    # Validated and serialized once, against AuthResponse
     return {
         "message": "User registered successfully",
         "token": token,
-        "user": UserResponse(**user.dict())
+        "user": user_doc
     }
 
-@api_router.post("/auth/login", response_model=dict)
+@api_router.post("/auth/login", response_model=AuthResponse)
 async def login_user(login_data: UserLogin):
     # Find user
     user = await db.users.find_one({"email": login_data.email})
@@ -283,40 +635,28 @@ async def login_user(login_data: UserLogin):
     # Create JWT token
     token = create_jwt_token(user)
     
+    # Validated and serialized once, against AuthResponse (the password hash is dropped there)
     return {
         "message": "Login successful",
         "token": token,
-        "user": UserResponse(**user)
+        "user": user
     }
 
-# AI Suggestions endpoints
-@api_router.post("/suggestions/workout", response_model=WorkoutSuggestion)
-async def get_workout_suggestion(current_user: User = Depends(get_current_user)):
-    # Check if user has access (premium or in trial)
-    trial_end = current_user.trial_end_date
-    if trial_end.tzinfo is None:
-        trial_end = trial_end.replace(tzinfo=timezone.utc)
-    if not current_user.is_premium and datetime.now(timezone.utc) > trial_end:
-        raise HTTPException(status_code=403, detail="Trial expired. Please upgrade to premium.")
-    
-    # Initialize Gemini chat
-    chat = LlmChat(
-        api_key=os.environ['EMERGENT_LLM_KEY'],
-        session_id=f"workout_{current_user.id}_{uuid.uuid4()}",
-        system_message="Você é um personal trainer especialista em IA. Crie sugestões de treinos personalizados em português brasileiro. Seja específico com exercícios, séries, repetições e dicas importantes."
-    ).with_model("gemini", "gemini-2.0-flash")
-    
-    # Create personalized prompt
-    user_message = UserMessage(
-        text=f"""
+# AI suggestion generation
+WORKOUT_SYSTEM_MESSAGE = "Você é um personal trainer especialista em IA. Crie sugestões de treinos personalizados em português brasileiro. Seja específico com exercícios, séries, repetições e dicas importantes."
+NUTRITION_SYSTEM_MESSAGE = "Você é um nutricionista especialista em IA. Crie sugestões de dietas personalizadas em português brasileiro. Seja específico com refeições, porções e dicas nutricionais importantes."
+
+def build_workout_prompt(user: User) -> str:
+    """Build the personalized workout prompt for a user"""
+    return f"""
         Crie uma sugestão de treino personalizada para:
-        👤 Nome: {current_user.name}
-        🎂 Idade: {current_user.age} anos
-        ⚖️ Peso: {current_user.weight}kg
-        📏 Altura: {current_user.height}cm
-        🎯 Objetivos: {current_user.goals}
-        🏠 Local de Treino: {current_user.workout_type}
-        🏃 Atividades Atuais: {current_user.current_activities if current_user.current_activities else "Nenhuma atividade informada"}
+        👤 Nome: {user.name}
+        🎂 Idade: {user.age} anos
+        ⚖️ Peso: {user.weight}kg
+        📏 Altura: {user.height}cm
+        🎯 Objetivos: {user.goals}
+        🏠 Local de Treino: {user.workout_type}
+        🏃 Atividades Atuais: {user.current_activities if user.current_activities else "Nenhuma atividade informada"}
         
         🎯 CONSIDERE AS ATIVIDADES ATUAIS:
         - Se já pratica atividades, COMPLEMENTE o treino considerando o que já faz
@@ -337,7 +677,7 @@ async def get_workout_suggestion(current_user: User = Depends(get_current_user))
         
         💪 TREINO PRINCIPAL
         Para cada exercício, inclua:
-        - Nome do exercício (adequado para {current_user.workout_type})
+        - Nome do exercício (adequado para {user.workout_type})
         - Séries x Repetições
         - Tempo de descanso
         - Dica técnica importante
@@ -350,7 +690,7 @@ async def get_workout_suggestion(current_user: User = Depends(get_current_user))
         - 2-3 orientações específicas para evitar lesões no ambiente escolhido
         
         💡 DICAS ESPECÍFICAS PARA O LOCAL:
-        - Orientações sobre o espaço e equipamentos para {current_user.workout_type}
+        - Orientações sobre o espaço e equipamentos para {user.workout_type}
         
         IMPORTANTE: 
         - Use emojis para deixar mais visual e atrativo
@@ -362,50 +702,17 @@ async def get_workout_suggestion(current_user: User = Depends(get_current_user))
         - Se for academia: aproveite ao máximo os equipamentos disponíveis
         - Se for ar livre: foque em exercícios que usam o ambiente natural
         """
-    )
-    
-    # Get AI response
-    response = await chat.send_message(user_message)
-    
-    # Format the response
-    formatted_response = format_ai_response(response)
-    
-    # Save suggestion to database
-    suggestion = WorkoutSuggestion(
-        user_id=current_user.id,
-        suggestion=formatted_response
-    )
-    
-    await db.workout_suggestions.insert_one(suggestion.dict())
-    
-    return suggestion
 
-@api_router.post("/suggestions/nutrition", response_model=NutritionSuggestion)
-async def get_nutrition_suggestion(current_user: User = Depends(get_current_user)):
-    # Check if user has access (premium or in trial)
-    trial_end = current_user.trial_end_date
-    if trial_end.tzinfo is None:
-        trial_end = trial_end.replace(tzinfo=timezone.utc)
-    if not current_user.is_premium and datetime.now(timezone.utc) > trial_end:
-        raise HTTPException(status_code=403, detail="Trial expired. Please upgrade to premium.")
-    
-    # Initialize Gemini chat
-    chat = LlmChat(
-        api_key=os.environ['EMERGENT_LLM_KEY'],
-        session_id=f"nutrition_{current_user.id}_{uuid.uuid4()}",
-        system_message="Você é um nutricionista especialista em IA. Crie sugestões de dietas personalizadas em português brasileiro. Seja específico com refeições, porções e dicas nutricionais importantes."
-    ).with_model("gemini", "gemini-2.0-flash")
-    
-    # Create personalized prompt
-    user_message = UserMessage(
-        text=f"""
+def build_nutrition_prompt(user: User) -> str:
+    """Build the personalized nutrition prompt for a user"""
+    return f"""
         Crie uma sugestão de dieta personalizada ACESSÍVEL E ECONÔMICA para:
-        👤 Nome: {current_user.name}
-        🎂 Idade: {current_user.age} anos
-        ⚖️ Peso: {current_user.weight}kg
-        📏 Altura: {current_user.height}cm
-        🎯 Objetivos: {current_user.goals}
-        🚫 Restrições Alimentares: {current_user.dietary_restrictions if current_user.dietary_restrictions else "Nenhuma restrição informada"}
+        👤 Nome: {user.name}
+        🎂 Idade: {user.age} anos
+        ⚖️ Peso: {user.weight}kg
+        📏 Altura: {user.height}cm
+        🎯 Objetivos: {user.goals}
+        🚫 Restrições Alimentares: {user.dietary_restrictions if user.dietary_restrictions else "Nenhuma restrição informada"}
         
         🎯 FOQUE EM ALIMENTOS ACESSÍVEIS: 
         - Alimentos de baixo custo e fácil acesso
@@ -472,67 +779,1150 @@ async def get_nutrition_suggestion(current_user: User = Depends(get_current_user
         - Seja específico sobre ingredientes quando houver restrições
         - Adapte às necessidades calóricas considerando o orçamento limitado
         """
+
+SUGGESTION_TYPES = {
+    "workout": {
+        "collection": "workout_suggestions",
+        "model": WorkoutSuggestion,
+        "system_message": WORKOUT_SYSTEM_MESSAGE,
+        "build_prompt": build_workout_prompt,
+    },
+    "nutrition": {
+        "collection": "nutrition_suggestions",
+        "model": NutritionSuggestion,
+        "system_message": NUTRITION_SYSTEM_MESSAGE,
+        "build_prompt": build_nutrition_prompt,
+    },
+}
+
+# Prompt experiments
+# Users are assigned to a variant by hashing their id, so the assignment is stable
+# across requests. Weights can be overridden with PROMPT_VARIANT_WEIGHTS, e.g.
+# {"workout": {"control": 50, "compact": 50}}; the variant is recorded with every
+# generation in llm_generations (see prompt_experiment_report.py).
+class PromptVariant:
+    def __init__(self, name: str, system_message: str, build_prompt, weight: int = 0):
+        self.name = name
+        self.system_message = system_message
+        self.build_prompt = build_prompt
+        self.weight = weight
+
+PROMPT_VARIANTS: Dict[str, List[PromptVariant]] = {suggestion_type: [] for suggestion_type in SUGGESTION_TYPES}
+PROMPT_VARIANT_WEIGHTS = json.loads(os.environ['PROMPT_VARIANT_WEIGHTS']) if os.environ.get('PROMPT_VARIANT_WEIGHTS') else {}
+
+def register_prompt_variant(suggestion_type: str, variant: PromptVariant):
+    """Register a prompt variant, applying any configured weight override"""
+    variant.weight = PROMPT_VARIANT_WEIGHTS.get(suggestion_type, {}).get(variant.name, variant.weight)
+    PROMPT_VARIANTS[suggestion_type].append(variant)
+
+def assign_prompt_variant(suggestion_type: str, user_id: str) -> PromptVariant:
+    """Deterministically assign a user to one of the active variants"""
+    variants = [variant for variant in PROMPT_VARIANTS[suggestion_type] if variant.weight > 0]
+    if not variants:
+        return PROMPT_VARIANTS[suggestion_type][0]
+    
+    digest = hashlib.sha256(f"{suggestion_type}:{user_id}".encode('utf-8')).hexdigest()
+    bucket = int(digest[:8], 16) % sum(variant.weight for variant in variants)
+    for variant in variants:
+        if bucket < variant.weight:
+            return variant
+        bucket -= variant.weight
+
+def build_compact_workout_prompt(user: User) -> str:
+    """Shorter workout prompt, candidate to replace the control prompt"""
+    return f"""
+        Crie um treino personalizado para {user.name}, {user.age} anos, {user.weight}kg, {user.height}cm.
+        Objetivos: {user.goals}. Local: {user.workout_type}. Atividades atuais: {user.current_activities if user.current_activities else "nenhuma"}.
+        
+        Estrutura: 🔥 aquecimento (3-4 exercícios), 💪 treino principal (exercício, séries x repetições, descanso, dica técnica, equipamento), 🧘 alongamento (3-4 exercícios), ⚠️ 2-3 dicas de segurança.
+        Complemente as atividades atuais sem sobrecarregar os mesmos grupos musculares e use apenas o que existe no local de treino.
+        Use emojis, não use asteriscos (*), seja específico com números e objetivo no texto.
+        """
+
+def build_compact_nutrition_prompt(user: User) -> str:
+    """Shorter nutrition prompt, candidate to replace the control prompt"""
+    return f"""
+        Crie uma dieta ACESSÍVEL E ECONÔMICA para {user.name}, {user.age} anos, {user.weight}kg, {user.height}cm.
+        Objetivos: {user.goals}. Restrições alimentares: {user.dietary_restrictions if user.dietary_restrictions else "nenhuma"}.
+        
+        Use apenas alimentos baratos e comuns (ovos, frango, carne moída, arroz, feijão, batata, banana, aveia, leite, verduras básicas).
+        Refeições: ☀️ café da manhã, 🥤 lanche da manhã, 🍽️ almoço, 🍎 lanche da tarde, 🌙 jantar, 🌜 ceia; 2-3 opções por refeição com porções exatas.
+        Inclua 💡 3 dicas de economia e 💰 uma variação semanal resumida.
+        RESPEITE RIGOROSAMENTE as restrições. Use emojis, não use asteriscos (*) e seja objetivo no texto.
+        """
+
+register_prompt_variant("workout", PromptVariant("control", WORKOUT_SYSTEM_MESSAGE, build_workout_prompt, weight=100))
+register_prompt_variant("workout", PromptVariant("compact", WORKOUT_SYSTEM_MESSAGE, build_compact_workout_prompt))
+register_prompt_variant("nutrition", PromptVariant("control", NUTRITION_SYSTEM_MESSAGE, build_nutrition_prompt, weight=100))
+register_prompt_variant("nutrition", PromptVariant("compact", NUTRITION_SYSTEM_MESSAGE, build_compact_nutrition_prompt))
+
+# Number of LLM calls currently running, used to keep pre-generation out of the way
+llm_in_flight = 0
+
+def profile_fingerprint(user: User) -> str:
+    """Hash of the profile fields the suggestion prompts depend on"""
+    fields = [user.name, user.age, user.weight, user.height, user.goals,
+              user.dietary_restrictions, user.workout_type, user.current_activities]
+    return hashlib.sha256("|".join(str(field) for field in fields).encode('utf-8')).hexdigest()
+
+class RouteStats:
+    """Rolling latency and token counters for one route"""
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.latencies_ms = deque(maxlen=100)  # (monotonic time, latency)
+        self.consecutive_errors = 0
+        self.breaker_open_until = 0.0
+    
+    def add_latency(self, latency_ms: float):
+        self.latencies_ms.append((time.monotonic(), latency_ms))
+        self.consecutive_errors = 0
+    
+    def add_error(self):
+        self.consecutive_errors += 1
+        if self.consecutive_errors >= LLM_BREAKER_FAILURES:
+            self.breaker_open_until = time.monotonic() + LLM_BREAKER_COOLDOWN_SECONDS
+    
+    def breaker_open(self) -> bool:
+        return time.monotonic() < self.breaker_open_until
+    
+    def p95_ms(self) -> Optional[float]:
+        since = time.monotonic() - LLM_STATS_WINDOW_SECONDS
+        recent = sorted(latency for at, latency in self.latencies_ms if at >= since)
+        if len(recent) < 5:
+            return None
+        return recent[int(len(recent) * 0.95) - 1]
+    
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "fallbacks": self.fallbacks,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "p95_latency_ms": self.p95_ms(),
+            "breaker_open": self.breaker_open()
+        }
+
+# Keyed by "<route>:<model>"
+route_stats: Dict[str, RouteStats] = {}
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), the LLM client does not report usage"""
+    return max(1, len(text) // 4)
+
+def select_route(suggestion_type: str, user: User, followup: bool = False) -> str:
+    """Pick a model route for a request from the configured routing rules"""
+    if followup and "followup" in ROUTING_RULES:
+        return ROUTING_RULES["followup"]
+    if user.access_state != "premium" and "trial" in ROUTING_RULES:
+        return ROUTING_RULES["trial"]
+    return ROUTING_RULES.get(suggestion_type, "standard")
+
+def route_models(route: str) -> List[tuple]:
+    """Models to try for a route, primary first unless its breaker is open or its latency SLO is breached"""
+    config = MODEL_ROUTES[route]
+    primary = tuple(config["model"])
+    fallback = tuple(config["fallback"]) if config.get("fallback") else None
+    if fallback is None:
+        return [primary]
+    
+    stats = route_stats.get(f"{route}:{primary[1]}")
+    if stats is None:
+        return [primary, fallback]
+    if stats.breaker_open():
+        return [fallback, primary]
+    p95 = stats.p95_ms()
+    # Probes keep fresh primary latencies coming in so a breach can clear
+    if p95 is not None and p95 > config["latency_slo_ms"] and random.random() >= LLM_PRIMARY_PROBE_RATE:
+        return [fallback, primary]
+    return [primary, fallback]
+
+async def record_generation(route: str, model: str, latency_ms: float, prompt_tokens: int, output_tokens: int, fallback: bool,
+                            error: bool = False, output_chars: int = 0, labels: Optional[dict] = None, queue_ms: float = 0.0):
+    """Keep per-route stats in memory and store the generation for offline analysis"""
+    stats = route_stats.setdefault(f"{route}:{model}", RouteStats())
+    stats.calls += 1
+    stats.errors += int(error)
+    stats.fallbacks += int(fallback)
+    if error:
+        stats.add_error()
+    else:
+        stats.add_latency(latency_ms)
+        stats.prompt_tokens += prompt_tokens
+        stats.output_tokens += output_tokens
+    
+    try:
+        await db.llm_generations.insert_one({
+            "route": route,
+            "model": model,
+            "latency_ms": round(latency_ms, 1),
+            "queue_ms": round(queue_ms, 1),
+            "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens,
+            "output_chars": output_chars,
+            "fallback": fallback,
+            "error": error,
+            "created_at": datetime.now(timezone.utc),
+            **(labels or {})
+        })
+    except Exception as e:
+        logging.error(f"Error recording LLM generation: {str(e)}")
+
+async def send_llm_message(session_id: str, system_message: str, text: str, route: str = "standard",
+                           labels: Optional[dict] = None) -> str:
+    """Send one message through a model route, respecting the global LLM concurrency budget"""
+    global llm_in_flight
+    prompt_tokens = estimate_tokens(system_message + text)
+    models = route_models(route)
+    
+    for attempt, (provider, model) in enumerate(models):
+        # Initialize Gemini chat
+        chat = LlmChat(
+            api_key=os.environ['EMERGENT_LLM_KEY'],
+            session_id=session_id,
+            system_message=system_message
+        ).with_model(provider, model)
+        
+        queued = time.perf_counter()
+        async with llm_semaphore:
+            # Model latency starts once we hold a slot; waiting for our own budget is queue time
+            started = time.perf_counter()
+            queue_ms = (started - queued) * 1000
+            llm_in_flight += 1
+            try:
+                response = await chat.send_message(UserMessage(text=text))
+                latency_ms = (time.perf_counter() - started) * 1000
+            except Exception as e:
+                latency_ms = (time.perf_counter() - started) * 1000
+                start_background_task(record_generation(route, model, latency_ms, prompt_tokens, 0, attempt > 0,
+                                                        error=True, labels=labels, queue_ms=queue_ms))
+                if attempt == len(models) - 1:
+                    raise
+                logging.warning(f"LLM route {route} failed on {model}, trying fallback: {str(e)}")
+                continue
+            finally:
+                llm_in_flight -= 1
+        
+        formatted_response = format_ai_response(response)
+        start_background_task(record_generation(route, model, latency_ms, prompt_tokens, estimate_tokens(response), attempt > 0,
+                                                output_chars=len(formatted_response), labels=labels, queue_ms=queue_ms))
+        return formatted_response
+
+async def generate_suggestion_text(suggestion_type: str, user: User) -> str:
+    """Ask Gemini for a new suggestion"""
+    variant = assign_prompt_variant(suggestion_type, user.id)
+    return await send_llm_message(
+        f"{suggestion_type}_{user.id}_{uuid.uuid4()}",
+        variant.system_message,
+        variant.build_prompt(user),
+        route=select_route(suggestion_type, user),
+        labels={"suggestion_type": suggestion_type, "variant": variant.name}
     )
+
+async def take_pregenerated_suggestion(suggestion_type: str, user: User) -> Optional[str]:
+    """Consume a pre-generated suggestion if one matches the current profile"""
+    if not PREGEN_ENABLED:
+        return None
+    doc = await db.pregenerated_suggestions.find_one_and_delete({
+        "user_id": user.id,
+        "type": suggestion_type,
+        "profile_hash": profile_fingerprint(user)
+    })
+    return doc["suggestion"] if doc else None
+
+# Suggestion storage codec
+# Documents record the codec used for their "suggestion" field: no codec means
+# plain text, "zlib" a zlib stream and "zstd:<dict_id>" a zstd frame compressed
+# with a dictionary trained on our own suggestions (dict_id 0 = no dictionary).
+zstd_dictionaries: Dict[int, "zstandard.ZstdCompressionDict"] = {}
+ZSTD_DICTIONARY_SIZE = 64 * 1024
+ZSTD_TRAINING_SAMPLES = 2000
+
+def current_codec() -> Optional[str]:
+    if SUGGESTION_CODEC == "zlib":
+        return "zlib"
+    if SUGGESTION_CODEC == "zstd" and zstandard is not None:
+        return f"zstd:{max(zstd_dictionaries, default=0)}"
+    return None
+
+def check_suggestion_codec():
+    """Warn at startup when SUGGESTION_CODEC can't be used and new documents are stored as plain text"""
+    if SUGGESTION_CODEC not in ("none", "zlib", "zstd"):
+        logging.warning(f"Unknown SUGGESTION_CODEC {SUGGESTION_CODEC!r}, storing suggestions as plain text")
+    elif SUGGESTION_CODEC == "zstd" and zstandard is None:
+        logging.warning("SUGGESTION_CODEC=zstd but zstandard is not installed, storing suggestions as plain text")
+
+def encode_suggestion_doc(doc: dict) -> dict:
+    """Compress the suggestion text of a document about to be written"""
+    codec = current_codec()
+    if codec is None:
+        return doc
     
-    # Get AI response
-    response = await chat.send_message(user_message)
+    data = doc["suggestion"].encode('utf-8')
+    if codec == "zlib":
+        compressed = zlib.compress(data, SUGGESTION_CODEC_LEVEL)
+    else:
+        dict_id = int(codec.split(":")[1])
+        compressor = zstandard.ZstdCompressor(level=SUGGESTION_CODEC_LEVEL, dict_data=zstd_dictionaries.get(dict_id))
+        compressed = compressor.compress(data)
+    return {**doc, "suggestion": Binary(compressed), "codec": codec}
+
+async def decode_suggestion_doc(doc: dict) -> dict:
+    """Return the document with its suggestion text decompressed"""
+    codec = doc.get("codec")
+    if not codec:
+        return doc
     
-    # Format the response
-    formatted_response = format_ai_response(response)
+    data = bytes(doc["suggestion"])
+    if codec == "zlib":
+        text = zlib.decompress(data)
+    elif codec.startswith("zstd:"):
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd-encoded suggestions")
+        dict_id = int(codec.split(":")[1])
+        if dict_id and dict_id not in zstd_dictionaries:
+            # Trained by another instance after this one loaded its dictionaries
+            await load_zstd_dictionary(dict_id)
+        text = zstandard.ZstdDecompressor(dict_data=zstd_dictionaries.get(dict_id)).decompress(data)
+    else:
+        raise ValueError(f"Unknown suggestion codec {codec}")
     
-    # Save suggestion to database
-    suggestion = NutritionSuggestion(
-        user_id=current_user.id,
-        suggestion=formatted_response
+    decoded = {key: value for key, value in doc.items() if key != "codec"}
+    decoded["suggestion"] = text.decode('utf-8')
+    return decoded
+
+async def load_zstd_dictionaries():
+    async for stored in db.codec_dictionaries.find({}, {"_id": 0}):
+        zstd_dictionaries[stored["dict_id"]] = zstandard.ZstdCompressionDict(bytes(stored["data"]))
+
+async def load_zstd_dictionary(dict_id: int):
+    stored = await db.codec_dictionaries.find_one({"dict_id": dict_id}, {"_id": 0})
+    if not stored:
+        raise ValueError(f"Unknown zstd dictionary {dict_id}")
+    zstd_dictionaries[dict_id] = zstandard.ZstdCompressionDict(bytes(stored["data"]))
+
+async def train_zstd_dictionary() -> Optional[int]:
+    """Train a zstd dictionary from a sample of stored suggestions"""
+    samples = []
+    for suggestion_type in SUGGESTION_TYPES:
+        collection, type_query = suggestion_source(suggestion_type)
+        pipeline = [
+            {"$match": type_query},
+            {"$sample": {"size": ZSTD_TRAINING_SAMPLES // len(SUGGESTION_TYPES)}},
+            {"$project": {"_id": 0, "suggestion": 1, "codec": 1}}
+        ]
+        async for doc in collection.aggregate(pipeline):
+            samples.append((await decode_suggestion_doc(doc))["suggestion"].encode('utf-8'))
+    if len(samples) < 100:
+        return None
+    
+    trained = zstandard.train_dictionary(ZSTD_DICTIONARY_SIZE, samples)
+    # Ids come from Mongo and the unique index makes concurrent trainers pick distinct ones
+    while True:
+        latest = await db.codec_dictionaries.find_one({}, {"_id": 0, "dict_id": 1}, sort=[("dict_id", -1)])
+        dict_id = (latest["dict_id"] if latest else 0) + 1
+        try:
+            await db.codec_dictionaries.insert_one({
+                "dict_id": dict_id,
+                "data": Binary(trained.as_bytes()),
+                "created_at": datetime.now(timezone.utc)
+            })
+            break
+        except DuplicateKeyError:
+            continue
+    zstd_dictionaries[dict_id] = trained
+    return dict_id
+
+async def migrate_suggestion_codec(batch_size: int = 500):
+    """Re-encode stored suggestions with the current codec, in batches"""
+    if SUGGESTION_CODEC == "zstd" and zstandard is not None and not zstd_dictionaries:
+        await train_zstd_dictionary()
+    codec = current_codec()
+    
+    for collection_name in suggestion_collections():
+        collection = db[collection_name]
+        migrated = 0
+        while True:
+            docs = await collection.find({"codec": {"$ne": codec}}, {"_id": 1, "suggestion": 1, "codec": 1}).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            updates = []
+            for doc in docs:
+                encoded = encode_suggestion_doc(await decode_suggestion_doc(doc))
+                if codec is None:
+                    updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"suggestion": encoded["suggestion"]}, "$unset": {"codec": ""}}))
+                else:
+                    updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"suggestion": encoded["suggestion"], "codec": codec}}))
+            await collection.bulk_write(updates, ordered=False)
+            migrated += len(updates)
+            await asyncio.sleep(0)  # Let requests run between batches
+        if migrated:
+            logging.info(f"Re-encoded {migrated} documents in {collection_name} with codec {codec}")
+
+# History buckets
+# suggestion_buckets holds one document per user, type and month (split when it
+# reaches HISTORY_BUCKET_MAX_ENTRIES) with summary entries for the month, newest
+# first. The suggestion text stays in the suggestion documents only, so a summary
+# list is answered from the buckets alone and the text is loaded per opened item.
+BUCKET_TITLE_LENGTH = 80
+
+def bucket_entry(doc: dict) -> dict:
+    """Summary of a suggestion document whose text is already decoded"""
+    return {
+        "id": doc["id"],
+        "created_at": doc["created_at"],
+        "title": doc["suggestion"].split("\n", 1)[0][:BUCKET_TITLE_LENGTH],
+        "chars": len(doc["suggestion"])
+    }
+
+async def add_to_bucket(suggestion_type: str, doc: dict):
+    await db.suggestion_buckets.update_one(
+        {
+            "user_id": doc["user_id"],
+            "type": suggestion_type,
+            "month": doc["created_at"].strftime("%Y-%m"),
+            "count": {"$lt": HISTORY_BUCKET_MAX_ENTRIES}
+        },
+        {
+            "$push": {"entries": {"$each": [bucket_entry(doc)], "$sort": {"created_at": -1}}},
+            "$inc": {"count": 1}
+        },
+        upsert=True
+    )
+
+async def remove_from_bucket(suggestion_type: str, user_id: str, suggestion_id: str):
+    await db.suggestion_buckets.update_one(
+        {"user_id": user_id, "type": suggestion_type, "entries.id": suggestion_id},
+        {"$pull": {"entries": {"id": suggestion_id}}, "$inc": {"count": -1}}
+    )
+
+async def find_bucketed_summaries(suggestion_type: str, user_id: str, limit: int) -> List[dict]:
+    """Latest summary entries from the newest buckets (usually one or two documents)"""
+    entries = []
+    cursor = db.suggestion_buckets.find(
+        {"user_id": user_id, "type": suggestion_type, "count": {"$gt": 0}},
+        {"_id": 0, "entries": 1}
+    ).sort([("month", -1), ("_id", -1)])
+    async for bucket in cursor:
+        entries.extend(bucket["entries"])
+        if len(entries) >= limit:
+            break
+    entries.sort(key=lambda entry: entry["created_at"], reverse=True)
+    return entries[:limit]
+
+async def rebuild_user_buckets(suggestion_type: str, user_id: str) -> int:
+    """Rebuild a user's buckets for one type from the suggestion documents"""
+    collection, type_query = suggestion_source(suggestion_type)
+    buckets = []
+    async for doc in collection.find({"user_id": user_id, **type_query}, {"_id": 0, "type": 0}).sort("created_at", -1):
+        month = doc["created_at"].strftime("%Y-%m")
+        if not buckets or buckets[-1]["month"] != month or buckets[-1]["count"] >= HISTORY_BUCKET_MAX_ENTRIES:
+            buckets.append({"user_id": user_id, "type": suggestion_type, "month": month, "count": 0, "entries": []})
+        buckets[-1]["entries"].append(bucket_entry(await decode_suggestion_doc(doc)))
+        buckets[-1]["count"] += 1
+    
+    # Older buckets are inserted first so _id order matches creation order within a month
+    buckets.reverse()
+    await db.suggestion_buckets.delete_many({"user_id": user_id, "type": suggestion_type})
+    if buckets:
+        await db.suggestion_buckets.insert_many(buckets)
+    return len(buckets)
+
+async def migrate_history_to_buckets() -> int:
+    """Build buckets for every user from the existing suggestion documents"""
+    total = 0
+    for suggestion_type in SUGGESTION_TYPES:
+        collection, type_query = suggestion_source(suggestion_type)
+        async for group in collection.aggregate([{"$match": type_query}, {"$group": {"_id": "$user_id"}}], allowDiskUse=True):
+            total += await rebuild_user_buckets(suggestion_type, group["_id"])
+    return total
+
+# Unified suggestions collection
+def suggestion_source(suggestion_type: str):
+    """Collection and extra filter holding the documents of a suggestion type"""
+    if SUGGESTIONS_STORAGE == "unified":
+        return db.suggestions, {"type": suggestion_type}
+    return db[SUGGESTION_TYPES[suggestion_type]["collection"]], {}
+
+def suggestion_collections() -> List[str]:
+    """Every collection that can hold suggestion documents in the current storage mode"""
+    names = []
+    if SUGGESTIONS_STORAGE != "unified" or SUGGESTIONS_LEGACY_FALLBACK:
+        names += [config["collection"] for config in SUGGESTION_TYPES.values()]
+    if SUGGESTIONS_STORAGE != "split":
+        names.append("suggestions")
+    return names
+
+def merge_newest(primary: List[dict], legacy: List[dict], limit: int) -> List[dict]:
+    """Merge unified and not-yet-migrated legacy documents, newest first"""
+    seen = {doc["id"] for doc in primary}
+    merged = primary + [doc for doc in legacy if doc["id"] not in seen]
+    merged.sort(key=lambda doc: doc["created_at"], reverse=True)
+    return merged[:limit]
+
+async def find_suggestion_documents_by_ids(suggestion_type: str, user_id: str, suggestion_ids: List[str]) -> List[dict]:
+    collection, type_query = suggestion_source(suggestion_type)
+    query = {"user_id": user_id, "id": {"$in": suggestion_ids}, **type_query}
+    docs = await collection.find(query, {"_id": 0, "type": 0}).to_list(len(suggestion_ids))
+    if SUGGESTIONS_STORAGE == "unified" and SUGGESTIONS_LEGACY_FALLBACK and len(docs) < len(suggestion_ids):
+        legacy_collection = db[SUGGESTION_TYPES[suggestion_type]["collection"]]
+        legacy = await legacy_collection.find({"user_id": user_id, "id": {"$in": suggestion_ids}}, {"_id": 0}).to_list(len(suggestion_ids))
+        docs = merge_newest(docs, legacy, len(suggestion_ids))
+    return docs
+
+async def find_suggestion_documents(suggestion_type: str, user_id: str, limit: int) -> List[dict]:
+    collection, type_query = suggestion_source(suggestion_type)
+    docs = await collection.find({"user_id": user_id, **type_query}, {"_id": 0, "type": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+    
+    if SUGGESTIONS_STORAGE == "unified" and SUGGESTIONS_LEGACY_FALLBACK and len(docs) < limit:
+        legacy_collection = db[SUGGESTION_TYPES[suggestion_type]["collection"]]
+        legacy = await legacy_collection.find({"user_id": user_id}, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+        docs = merge_newest(docs, legacy, limit)
+    return docs
+
+async def find_timeline(user_id: str, limit: int = 20) -> List[dict]:
+    """Latest suggestions of every type, newest first"""
+    if SUGGESTIONS_STORAGE == "unified":
+        docs = await db.suggestions.find({"user_id": user_id}, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+        if not SUGGESTIONS_LEGACY_FALLBACK or len(docs) >= limit:
+            return [await decode_suggestion_doc(doc) for doc in docs]
+    else:
+        docs = []
+    
+    legacy = []
+    for suggestion_type, config in SUGGESTION_TYPES.items():
+        cursor = db[config["collection"]].find({"user_id": user_id}, {"_id": 0}).sort("created_at", -1).limit(limit)
+        legacy.extend({**doc, "type": suggestion_type} async for doc in cursor)
+    return [await decode_suggestion_doc(doc) for doc in merge_newest(docs, legacy, limit)]
+
+async def migrate_to_unified_collection(batch_size: int = 500):
+    """Copy legacy suggestion documents into the unified collection"""
+    for suggestion_type, config in SUGGESTION_TYPES.items():
+        copied = 0
+        last_id = None
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id else {}
+            docs = await db[config["collection"]].find(query).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            last_id = docs[-1]["_id"]
+            updates = []
+            for doc in docs:
+                unified_doc = {key: value for key, value in doc.items() if key != "_id"}
+                unified_doc["type"] = suggestion_type
+                updates.append(UpdateOne({"id": doc["id"]}, {"$setOnInsert": unified_doc}, upsert=True))
+            await db.suggestions.bulk_write(updates, ordered=False)
+            copied += len(docs)
+            await asyncio.sleep(0)  # Let requests run between batches
+        logging.info(f"Copied {copied} documents from {config['collection']} into suggestions")
+
+async def iter_suggestions(suggestion_type: str, user_id: str, limit: int = 20) -> AsyncIterator[dict]:
+    """Like find_suggestions, but yields documents straight from the cursor when possible"""
+    if SUGGESTIONS_STORAGE == "unified" and SUGGESTIONS_LEGACY_FALLBACK:
+        for doc in await find_suggestions(suggestion_type, user_id, limit):
+            yield doc
+        return
+    
+    collection, type_query = suggestion_source(suggestion_type)
+    async for doc in collection.find({"user_id": user_id, **type_query}, {"_id": 0, "type": 0}).sort("created_at", -1).limit(limit):
+        yield await decode_suggestion_doc(doc)
+
+async def iter_all_suggestions(user_id: str) -> AsyncIterator[dict]:
+    """Every stored suggestion of a user, tagged with its type (used by exports)"""
+    sources = [(suggestion_type, *suggestion_source(suggestion_type)) for suggestion_type in SUGGESTION_TYPES]
+    if SUGGESTIONS_STORAGE == "unified" and SUGGESTIONS_LEGACY_FALLBACK:
+        sources += [(suggestion_type, db[config["collection"]], {}) for suggestion_type, config in SUGGESTION_TYPES.items()]
+    
+    seen = set()
+    for suggestion_type, collection, type_query in sources:
+        async for doc in collection.find({"user_id": user_id, **type_query}, {"_id": 0}).sort("created_at", -1):
+            if doc["id"] in seen:
+                continue
+            seen.add(doc["id"])
+            yield {**(await decode_suggestion_doc(doc)), "type": suggestion_type}
+
+# History change log
+# Every insert and delete gets the next value of the user's history_seq counter
+# and a history_changes entry, so clients can ask for what changed since a seq.
+async def record_history_change(user_id: str, op: str, suggestion_type: str, suggestion_id: str):
+    user_doc = await db.users.find_one_and_update(
+        {"id": user_id},
+        {"$inc": {"history_seq": 1}},
+        projection={"_id": 0, "history_seq": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not user_doc:
+        return
+    
+    # Keep the cached user's version current so ETags change immediately
+    cached_user = user_cache.get(user_id)
+    if cached_user is not None:
+        cached_user.history_seq = user_doc["history_seq"]
+    
+    await db.history_changes.insert_one({
+        "user_id": user_id,
+        "seq": user_doc["history_seq"],
+        "op": op,
+        "type": suggestion_type,
+        "id": suggestion_id,
+        "created_at": datetime.now(timezone.utc)
+    })
+
+async def save_suggestion(suggestion_type: str, suggestion):
+    """Persist a suggestion in its history collection"""
+    plain_doc = suggestion.dict()
+    doc = encode_suggestion_doc(plain_doc)
+    if SUGGESTIONS_STORAGE in ("split", "dual"):
+        await db[SUGGESTION_TYPES[suggestion_type]["collection"]].insert_one(dict(doc))
+    if SUGGESTIONS_STORAGE in ("dual", "unified"):
+        await db.suggestions.insert_one({**doc, "type": suggestion_type})
+    if HISTORY_BUCKETS_ENABLED:
+        await add_to_bucket(suggestion_type, plain_doc)
+    await record_history_change(suggestion.user_id, "upsert", suggestion_type, suggestion.id)
+
+async def find_suggestions(suggestion_type: str, user_id: str, limit: int = 20) -> List[dict]:
+    """Latest suggestions of a user, newest first, with their text decoded"""
+    docs = await find_suggestion_documents(suggestion_type, user_id, limit)
+    return [await decode_suggestion_doc(doc) for doc in docs]
+
+async def find_history_summaries(suggestion_type: str, user_id: str, limit: int = 20, layout: Optional[str] = None) -> List[dict]:
+    """Latest suggestion summaries of a user, newest first"""
+    if (layout or HISTORY_READ_LAYOUT) == "buckets":
+        entries = await find_bucketed_summaries(suggestion_type, user_id, limit)
+    else:
+        entries = [bucket_entry(await decode_suggestion_doc(doc)) for doc in await find_suggestion_documents(suggestion_type, user_id, limit)]
+    return [{**entry, "type": suggestion_type} for entry in entries]
+
+async def delete_suggestion(suggestion_type: str, user_id: str, suggestion_id: str) -> bool:
+    query = {"id": suggestion_id, "user_id": user_id}
+    deleted = 0
+    if SUGGESTIONS_STORAGE != "split":
+        deleted += (await db.suggestions.delete_one({**query, "type": suggestion_type})).deleted_count
+    if SUGGESTIONS_STORAGE != "unified" or SUGGESTIONS_LEGACY_FALLBACK:
+        deleted += (await db[SUGGESTION_TYPES[suggestion_type]["collection"]].delete_one(query)).deleted_count
+    if deleted and HISTORY_BUCKETS_ENABLED:
+        await remove_from_bucket(suggestion_type, user_id, suggestion_id)
+    if deleted:
+        forget_conversation(user_id, suggestion_type, [suggestion_id])
+        await record_history_change(user_id, "delete", suggestion_type, suggestion_id)
+    return deleted > 0
+
+async def create_suggestion(suggestion_type: str, user: User):
+    """Serve a suggestion from storage when pre-generated, otherwise generate it live"""
+    text = await take_pregenerated_suggestion(suggestion_type, user)
+    if text is None:
+        text = await generate_suggestion_text(suggestion_type, user)
+    
+    suggestion = SUGGESTION_TYPES[suggestion_type]["model"](
+        user_id=user.id,
+        suggestion=text
     )
+    await save_suggestion(suggestion_type, suggestion)
+    remember_conversation(user.id, suggestion_type, suggestion.id, text)
+    return suggestion
+
+# Follow-up conversations
+# Only the latest plan is kept per user and type (zlib-compressed). A follow-up sends
+# the section titles plus the sections the request mentions, and the model answers
+# with just the rewritten sections, which are merged back into the stored plan.
+FOLLOWUP_SYSTEM_MESSAGE = "Você ajusta planos já criados em português brasileiro. Aplique somente a alteração pedida e responda apenas com as seções alteradas, cada uma começando pelo seu título exatamente como recebido, no mesmo formato com emojis e sem asteriscos (*)."
+FOLLOWUP_MIN_WORD_LENGTH = 4
+FOLLOWUP_STOPWORDS = {"para", "como", "mais", "menos", "minha", "meus", "minhas", "quero", "queria", "pode", "favor",
+                      "troque", "trocar", "mude", "mudar", "altere", "alterar", "coloque", "colocar", "tire", "tirar",
+                      "remova", "remover", "adicione", "adicionar", "sem", "com", "uma", "por", "isso", "esse", "essa"}
+conversation_states = TTLCache(
+    maxsize=int(os.environ.get('FOLLOWUP_MAX_CONVERSATIONS', 5000)),
+    ttl=int(os.environ.get('FOLLOWUP_TTL_MINUTES', 60)) * 60
+)
+
+def remember_conversation(user_id: str, suggestion_type: str, suggestion_id: str, text: str):
+    conversation_states[(user_id, suggestion_type)] = (suggestion_id, zlib.compress(text.encode('utf-8')))
+
+def forget_conversation(user_id: str, suggestion_type: str, suggestion_ids: List[str]):
+    """Drop the cached plan when it is one of the suggestions being removed"""
+    state = conversation_states.get((user_id, suggestion_type))
+    if state and state[0] in suggestion_ids:
+        conversation_states.pop((user_id, suggestion_type), None)
+
+async def load_conversation_plan(user_id: str, suggestion_type: str) -> Optional[str]:
+    """Latest plan for a follow-up, from memory or from the most recent stored suggestion"""
+    state = conversation_states.get((user_id, suggestion_type))
+    if state:
+        # Another instance may have deleted or archived the cached plan
+        collection, type_query = suggestion_source(suggestion_type)
+        if await collection.find_one({"id": state[0], "user_id": user_id, **type_query}, {"_id": 1}):
+            return zlib.decompress(state[1]).decode('utf-8')
+        conversation_states.pop((user_id, suggestion_type), None)
     
-    await db.nutrition_suggestions.insert_one(suggestion.dict())
+    latest_docs = await find_suggestions(suggestion_type, user_id, limit=1)
+    if not latest_docs:
+        return None
+    latest = latest_docs[0]
+    remember_conversation(user_id, suggestion_type, latest["id"], latest["suggestion"])
+    return latest["suggestion"]
+
+def is_section_title(line: str) -> bool:
+    """Plan headings start with an emoji, e.g. "💪 TREINO PRINCIPAL" or "💡 DICAS PARA O LOCAL:" """
+    line = line.strip()
+    if not line or len(line) > 80 or line[0].isalnum() or line[0] in "-•(":
+        return False
+    return ":" not in line.rstrip(":")
+
+def split_plan_sections(plan: str) -> List[str]:
+    """Split a formatted plan into sections, each starting at a heading line"""
+    sections: List[List[str]] = []
+    for line in plan.split("\n\n"):
+        if not sections or is_section_title(line):
+            sections.append([])
+        sections[-1].append(line)
+    return ["\n\n".join(lines) for lines in sections]
+
+def section_key(section: str) -> str:
+    return " ".join(section.split("\n", 1)[0].lower().split()).rstrip(":")
+
+def plan_words(text: str) -> set:
+    return {word for word in "".join(c if c.isalnum() else " " for c in text.lower()).split() if len(word) >= FOLLOWUP_MIN_WORD_LENGTH and word not in FOLLOWUP_STOPWORDS}
+
+def select_followup_sections(sections: List[str], message: str) -> List[int]:
+    """Sections sharing words with the request; all of them when nothing matches"""
+    words = plan_words(message)
+    selected = [index for index, section in enumerate(sections) if words & plan_words(section)]
+    return selected or list(range(len(sections)))
+
+def merge_followup_sections(sections: List[str], selected: List[int], response: str) -> str:
+    """Replace the rewritten sections by title; an answer without known titles replaces the whole selection"""
+    updated = split_plan_sections(response)
+    positions = {section_key(sections[index]): index for index in selected}
+    merged = list(sections)
+    unmatched = []
+    for section in updated:
+        index = positions.get(section_key(section))
+        if index is None:
+            unmatched.append(section)
+        else:
+            merged[index] = section
+    
+    if len(unmatched) == len(updated):
+        merged = [section for index, section in enumerate(sections) if index not in selected]
+        merged[selected[0]:selected[0]] = [response]
+    elif unmatched:
+        merged[selected[-1] + 1:selected[-1] + 1] = unmatched
+    return "\n\n".join(merged)
+
+async def create_followup_suggestion(suggestion_type: str, user: User, message: str):
+    """Adjust the user's latest plan with a short follow-up request"""
+    plan = await load_conversation_plan(user.id, suggestion_type)
+    if plan is None:
+        raise HTTPException(status_code=404, detail="Nenhuma sugestão anterior para ajustar")
+    
+    sections = split_plan_sections(plan)
+    selected = select_followup_sections(sections, message)
+    titles = " | ".join(section.split("\n", 1)[0] for section in sections)
+    excerpt = "\n\n".join(sections[index] for index in selected)
     
+    response = await send_llm_message(
+        f"{suggestion_type}_followup_{user.id}_{uuid.uuid4()}",
+        FOLLOWUP_SYSTEM_MESSAGE,
+        f"TÍTULOS DO PLANO: {titles}\n\nSEÇÕES PARA AJUSTAR:\n{excerpt}\n\nALTERAÇÃO PEDIDA: {message}",
+        route=select_route(suggestion_type, user, followup=True),
+        labels={"suggestion_type": suggestion_type, "variant": "followup"}
+    )
+    text = merge_followup_sections(sections, selected, response)
+    
+    suggestion = SUGGESTION_TYPES[suggestion_type]["model"](
+        user_id=user.id,
+        suggestion=text
+    )
+    await save_suggestion(suggestion_type, suggestion)
+    remember_conversation(user.id, suggestion_type, suggestion.id, text)
     return suggestion
 
+# Background pre-generation
+# Jobs are (priority, sequence, user_id); profile updates (0) run before nightly batch jobs (1)
+pregen_queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+pregen_pending = set()
+pregen_sequence = 0
+def enqueue_pregeneration(user_id: str, priority: int = 0):
+    """Queue low-priority generation of fresh plans for a user"""
+    global pregen_sequence
+    if not PREGEN_ENABLED or user_id in pregen_pending:
+        return
+    pregen_pending.add(user_id)
+    pregen_sequence += 1
+    pregen_queue.put_nowait((priority, pregen_sequence, user_id))
+
+async def is_recently_active(user_id: str) -> bool:
+    cutoff = datetime.now(timezone.utc) - timedelta(days=PREGEN_ACTIVE_DAYS)
+    for collection_name in suggestion_collections():
+        if await db[collection_name].find_one({"user_id": user_id, "created_at": {"$gte": cutoff}}, {"_id": 1}):
+            return True
+    return False
+
+async def pregenerate_for_user(user_id: str, check_activity: bool):
+    user_doc = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+    if not user_doc:
+        return
+    user = user_from_doc(user_doc)
+    if not has_access(user):
+        return
+    if check_activity and not await is_recently_active(user_id):
+        return
+    
+    fingerprint = profile_fingerprint(user)
+    for suggestion_type in SUGGESTION_TYPES:
+        # Wait while interactive requests need the reserved LLM slots
+        while llm_in_flight >= LLM_MAX_CONCURRENCY - PREGEN_RESERVED_SLOTS:
+            await asyncio.sleep(1)
+        text = await generate_suggestion_text(suggestion_type, user)
+        await db.pregenerated_suggestions.replace_one(
+            {"user_id": user_id, "type": suggestion_type},
+            {
+                "user_id": user_id,
+                "type": suggestion_type,
+                "suggestion": text,
+                "profile_hash": fingerprint,
+                "created_at": datetime.now(timezone.utc)
+            },
+            upsert=True
+        )
+
+async def pregeneration_worker():
+    """Process queued pre-generation jobs one at a time"""
+    while True:
+        priority, _, user_id = await pregen_queue.get()
+        try:
+            await pregenerate_for_user(user_id, check_activity=priority > 0)
+        except Exception as e:
+            logging.error(f"Error pre-generating suggestions for {user_id}: {str(e)}")
+        finally:
+            pregen_pending.discard(user_id)
+            pregen_queue.task_done()
+
+async def nightly_pregeneration_batch():
+    """Every night, enqueue pre-generation for recently active users"""
+    while True:
+        now = datetime.now(timezone.utc)
+        next_run = now.replace(hour=PREGEN_BATCH_HOUR_UTC, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        
+        try:
+            cutoff = datetime.now(timezone.utc) - timedelta(days=PREGEN_ACTIVE_DAYS)
+            active_user_ids = set()
+            for collection_name in suggestion_collections():
+                active_user_ids.update(await db[collection_name].distinct("user_id", {"created_at": {"$gte": cutoff}}))
+            for user_id in active_user_ids:
+                enqueue_pregeneration(user_id, priority=1)
+            logging.info(f"Nightly pre-generation queued for {len(active_user_ids)} users")
+        except Exception as e:
+            logging.error(f"Error queuing nightly pre-generation: {str(e)}")
+
+# AI Suggestions endpoints
+@api_router.post("/suggestions/workout", response_model=WorkoutSuggestion)
+async def get_workout_suggestion(
+    current_user: User = Depends(require_access),
+    idempotency_key: Optional[str] = Header(None)
+):
+    return await run_idempotent(
+        idempotency_key, "suggestions/workout", current_user.id,
+        lambda: create_suggestion("workout", current_user)
+    )
+
+@api_router.post("/suggestions/nutrition", response_model=NutritionSuggestion)
+async def get_nutrition_suggestion(
+    current_user: User = Depends(require_access),
+    idempotency_key: Optional[str] = Header(None)
+):
+    return await run_idempotent(
+        idempotency_key, "suggestions/nutrition", current_user.id,
+        lambda: create_suggestion("nutrition", current_user)
+    )
+
+@api_router.post("/suggestions/{suggestion_type}/followup")
+async def followup_suggestion(
+    suggestion_type: str,
+    followup: FollowUpRequest,
+    current_user: User = Depends(require_access),
+    idempotency_key: Optional[str] = Header(None)
+):
+    """Apply a follow-up request (e.g. "make it shorter") to the latest suggestion"""
+    if suggestion_type not in SUGGESTION_TYPES:
+        raise HTTPException(status_code=404, detail="Suggestion type not found")
+    
+    return await run_idempotent(
+        idempotency_key, f"suggestions/{suggestion_type}/followup", current_user.id,
+        lambda: create_followup_suggestion(suggestion_type, current_user, followup.message)
+    )
+
+# Streaming JSON responses
+# Documents are encoded one at a time as they come off the cursor, either as the
+# elements of a JSON array or as NDJSON lines (?format=ndjson or an
+# application/x-ndjson Accept header), so memory stays flat for any result size.
+SUGGESTION_FIELDS = ("id", "user_id", "suggestion", "created_at")
+HISTORY_ENTRY_FIELDS = ("id", "user_id", "type", "suggestion", "created_at")
+HISTORY_SUMMARY_FIELDS = ("id", "type", "title", "chars", "created_at")
+
+def encode_json(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, default=lambda obj: obj.isoformat()).encode('utf-8')
+
+async def iter_json(items: AsyncIterator[dict], fields: Optional[tuple], ndjson: bool) -> AsyncIterator[bytes]:
+    if not ndjson:
+        yield b"["
+    first = True
+    async for item in items:
+        if fields:
+            item = {field: item[field] for field in fields}
+        if ndjson:
+            yield encode_json(item) + b"\n"
+        else:
+            yield encode_json(item) if first else b"," + encode_json(item)
+        first = False
+    if not ndjson:
+        yield b"]"
+
+def stream_json(request: Request, items: AsyncIterator[dict], fields: Optional[tuple] = None,
+                headers: Optional[dict] = None) -> StreamingResponse:
+    """Stream documents as a JSON array, or NDJSON when the client asks for it"""
+    ndjson = request.query_params.get("format") == "ndjson" or "application/x-ndjson" in request.headers.get("accept", "")
+    media_type = "application/x-ndjson" if ndjson else "application/json"
+    return StreamingResponse(iter_json(items, fields, ndjson), media_type=media_type, headers=headers)
+
+async def iter_list(docs: List[dict]) -> AsyncIterator[dict]:
+    for doc in docs:
+        yield doc
+
+# Conditional GET
+# ETags come from per-user counters kept on the (cached) user document, so a
+# matching If-None-Match is answered with 304 before any history is loaded.
+def user_etag(user: User, resource: str, version: int) -> str:
+    return f'"{user.id}:{resource}:{version}"'
+
+def history_etag(request: Request, user: User, resource: str) -> str:
+    # JSON and NDJSON bodies of the same version are different representations
+    representation = "ndjson" if request.query_params.get("format") == "ndjson" or "application/x-ndjson" in request.headers.get("accept", "") else "json"
+    return user_etag(user, f"{resource}:{representation}", user.history_seq)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Weak comparison (RFC 9110): ignores W/ and the content-coding suffix added by CompressionMiddleware"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [identity_etag(candidate.strip()) for candidate in if_none_match.split(",")]
+    return "*" in candidates or identity_etag(etag) in candidates
+
+def etag_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=etag_headers(etag))
+
 # History endpoints
 @api_router.get("/history/workouts", response_model=List[WorkoutSuggestion])
-async def get_workout_history(current_user: User = Depends(get_current_user)):
-    suggestions = await db.workout_suggestions.find({"user_id": current_user.id}).sort("created_at", -1).limit(20).to_list(20)
-    return [WorkoutSuggestion(**suggestion) for suggestion in suggestions]
+async def get_workout_history(request: Request, current_user: User = Depends(get_current_user)):
+    etag = history_etag(request, current_user, "history:workout")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return stream_json(request, iter_suggestions("workout", current_user.id), SUGGESTION_FIELDS, headers=etag_headers(etag))
 
 @api_router.get("/history/nutrition", response_model=List[NutritionSuggestion])
-async def get_nutrition_history(current_user: User = Depends(get_current_user)):
-    suggestions = await db.nutrition_suggestions.find({"user_id": current_user.id}).sort("created_at", -1).limit(20).to_list(20)
-    return [NutritionSuggestion(**suggestion) for suggestion in suggestions]
+async def get_nutrition_history(request: Request, current_user: User = Depends(get_current_user)):
+    etag = history_etag(request, current_user, "history:nutrition")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return stream_json(request, iter_suggestions("nutrition", current_user.id), SUGGESTION_FIELDS, headers=etag_headers(etag))
+
+@api_router.get("/history", response_model=List[HistoryEntry])
+async def get_history_timeline(request: Request, current_user: User = Depends(get_current_user)):
+    """Combined workout and nutrition history"""
+    etag = history_etag(request, current_user, "history")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    suggestions = await find_timeline(current_user.id)
+    return stream_json(request, iter_list(suggestions), HISTORY_ENTRY_FIELDS, headers=etag_headers(etag))
+
+@api_router.get("/history/{suggestion_type}/summary", response_model=List[HistorySummary])
+async def get_history_summary(suggestion_type: str, request: Request, current_user: User = Depends(get_current_user)):
+    """Titles of the latest suggestions of a type; the text is loaded per item"""
+    if suggestion_type not in SUGGESTION_TYPES:
+        raise HTTPException(status_code=404, detail="Suggestion type not found")
+    etag = history_etag(request, current_user, f"history:{suggestion_type}:summary")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    summaries = await find_history_summaries(suggestion_type, current_user.id)
+    return stream_json(request, iter_list(summaries), HISTORY_SUMMARY_FIELDS, headers=etag_headers(etag))
+
+@api_router.get("/history/{suggestion_type}/items/{suggestion_id}", response_model=HistoryEntry)
+async def get_history_item(suggestion_type: str, suggestion_id: str, current_user: User = Depends(get_current_user)):
+    if suggestion_type not in SUGGESTION_TYPES:
+        raise HTTPException(status_code=404, detail="Suggestion type not found")
+    docs = await find_suggestions_by_ids(suggestion_type, current_user.id, [suggestion_id])
+    if not docs:
+        raise HTTPException(status_code=404, detail="Suggestion not found")
+    return model_response(HistoryEntry.model_construct(**{field: docs[0][field] for field in HISTORY_ENTRY_FIELDS}))
+
+@api_router.get("/user/export")
+async def export_user_data(request: Request, current_user: User = Depends(get_current_user)):
+    """Export every suggestion of the user (NDJSON by default)"""
+    ndjson = request.query_params.get("format", "ndjson") == "ndjson"
+    items = iter_json(iter_all_suggestions(current_user.id), HISTORY_ENTRY_FIELDS, ndjson)
+    return StreamingResponse(
+        items,
+        media_type="application/x-ndjson" if ndjson else "application/json",
+        headers={"Content-Disposition": 'attachment; filename="fitlife-export.ndjson"' if ndjson else 'attachment; filename="fitlife-export.json"'}
+    )
+
+async def find_suggestions_by_ids(suggestion_type: str, user_id: str, suggestion_ids: List[str]) -> List[dict]:
+    docs = await find_suggestion_documents_by_ids(suggestion_type, user_id, suggestion_ids)
+    return [{**(await decode_suggestion_doc(doc)), "type": suggestion_type} for doc in docs]
+
+@api_router.get("/history/sync", response_model=HistorySyncResponse)
+async def sync_history(since: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """Suggestions created and deleted since the client's last sync token"""
+    user_doc = await db.users.find_one({"id": current_user.id}, {"_id": 0, "history_seq": 1})
+    current_seq = (user_doc or {}).get("history_seq", 0)
+    since_seq = int(since) if since and since.isdigit() else None
+    
+    changes = []
+    if since_seq is not None and since_seq <= current_seq:
+        changes = await db.history_changes.find(
+            {"user_id": current_user.id, "seq": {"$gt": since_seq}},
+            {"_id": 0, "seq": 1, "op": 1, "type": 1, "id": 1}
+        ).sort("seq", 1).to_list(None)
+    
+    # Missing or expired change log entries mean the client has to start over
+    complete = since_seq is not None and since_seq <= current_seq and (
+        (changes and changes[0]["seq"] == since_seq + 1) or (not changes and since_seq == current_seq)
+    )
+    if not complete:
+        # Same snapshot as the per-type history lists: the latest 20 of each type
+        snapshot = []
+        for suggestion_type in SUGGESTION_TYPES:
+            snapshot.extend({**doc, "type": suggestion_type} for doc in await find_suggestions(suggestion_type, current_user.id, 20))
+        snapshot.sort(key=lambda doc: doc["created_at"], reverse=True)
+        return model_response(HistorySyncResponse.model_construct(
+            token=str(current_seq),
+            full=True,
+            suggestions=[HistoryEntry.model_construct(**{field: doc[field] for field in HISTORY_ENTRY_FIELDS}) for doc in snapshot],
+            deleted=[]
+        ))
+    
+    # Keep only the last operation per suggestion
+    latest_ops = {}
+    for change in changes:
+        latest_ops[(change["type"], change["id"])] = change["op"]
+    
+    suggestions = []
+    for suggestion_type in SUGGESTION_TYPES:
+        upserted = [suggestion_id for (change_type, suggestion_id), op in latest_ops.items() if change_type == suggestion_type and op == "upsert"]
+        if upserted:
+            suggestions.extend(await find_suggestions_by_ids(suggestion_type, current_user.id, upserted))
+    
+    return model_response(HistorySyncResponse.model_construct(
+        token=str(changes[-1]["seq"] if changes else current_seq),
+        full=False,
+        suggestions=[HistoryEntry.model_construct(**doc) for doc in suggestions],
+        deleted=[{"type": change_type, "id": suggestion_id} for (change_type, suggestion_id), op in latest_ops.items() if op == "delete"]
+    ))
 
 @api_router.delete("/history/workouts/{suggestion_id}")
 async def delete_workout_suggestion(suggestion_id: str, current_user: User = Depends(get_current_user)):
-    result = await db.workout_suggestions.delete_one({"id": suggestion_id, "user_id": current_user.id})
-    if result.deleted_count == 0:
+    if not await delete_suggestion("workout", current_user.id, suggestion_id):
         raise HTTPException(status_code=404, detail="Workout suggestion not found")
     return {"message": "Workout suggestion deleted successfully"}
 
 @api_router.delete("/history/nutrition/{suggestion_id}")
 async def delete_nutrition_suggestion(suggestion_id: str, current_user: User = Depends(get_current_user)):
-    result = await db.nutrition_suggestions.delete_one({"id": suggestion_id, "user_id": current_user.id})
-    if result.deleted_count == 0:
+    if not await delete_suggestion("nutrition", current_user.id, suggestion_id):
         raise HTTPException(status_code=404, detail="Nutrition suggestion not found")
     return {"message": "Nutrition suggestion deleted successfully"}
 
 # Payment endpoints
+# StripeCheckout clients are created at startup and shared by all requests: one for
+# status checks and webhooks, one for checkouts with the PUBLIC_BASE_URL webhook. Without
+# PUBLIC_BASE_URL the request host is used, in a small LRU so Host headers cannot grow it.
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', '').rstrip('/')
+STRIPE_STATUS_WEBHOOK_URL = "http://placeholder"  # Not used for status checks and webhook handling
+stripe_clients = LRUCache(maxsize=4)
+payment_status_inflight: Dict[tuple, asyncio.Future] = {}
+
+def stripe_webhook_url(host_url: str) -> str:
+    return f"{PUBLIC_BASE_URL or host_url}/api/webhook/stripe"
+
+def get_stripe_checkout(webhook_url: str = STRIPE_STATUS_WEBHOOK_URL) -> StripeCheckout:
+    stripe_checkout = stripe_clients.get(webhook_url)
+    if stripe_checkout is None:
+        stripe_checkout = StripeCheckout(api_key=stripe_api_key, webhook_url=webhook_url)
+        stripe_clients[webhook_url] = stripe_checkout
+    return stripe_checkout
+
+def recorded_checkout_status(transaction: dict) -> Optional[CheckoutStatusResponse]:
+    """Status of a transaction that already reached a terminal state, without asking Stripe"""
+    if transaction.get("checkout_status"):
+        return CheckoutStatusResponse(**transaction["checkout_status"])
+    if transaction.get("payment_status") == "completed":
+        # Completed through the webhook before any poll recorded the upstream status
+        return CheckoutStatusResponse(
+            status="complete",
+            payment_status="paid",
+            amount_total=int(round(transaction["amount"] * 100)),
+            currency=transaction["currency"],
+            metadata=transaction.get("metadata", {})
+        )
+    return None
+
 @api_router.post("/payments/checkout", response_model=CheckoutSessionResponse)
-async def create_checkout_session(request: Request, current_user: User = Depends(get_current_user)):
+async def create_checkout_session(
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
     if not stripe_api_key:
         raise HTTPException(status_code=500, detail="Payment system not configured")
     
+    # Get host URL from request
+    host_url = str(request.base_url).rstrip('/')
+    
+    return await run_idempotent(
+        idempotency_key, "payments/checkout", current_user.id,
+        lambda: start_checkout_session(host_url, current_user)
+    )
+
+async def find_open_checkout_session(host_url: str, user_id: str) -> Optional[CheckoutSessionResponse]:
+    """Pending checkout session of the user that can still be completed"""
+    transaction = await db.payment_transactions.find_one(
+        {
+            "user_id": user_id,
+            "payment_status": "pending",
+            "expires_at": {"$gt": datetime.now(timezone.utc)},
+            "host_url": host_url
+        },
+        {"_id": 0, "session_id": 1, "url": 1},
+        sort=[("expires_at", -1)]
+    )
+    if not transaction or not transaction.get("url"):
+        return None
+    return CheckoutSessionResponse(url=transaction["url"], session_id=transaction["session_id"])
+
+async def start_checkout_session(host_url: str, current_user: User) -> CheckoutSessionResponse:
+    open_session = await find_open_checkout_session(host_url, current_user.id)
+    if open_session:
+        return open_session
+    
     # Fixed subscription price - R$ 14.90 per month
     amount = 14.90
     currency = "brl"
     
-    # Get host URL from request
-    host_url = str(request.base_url).rstrip('/')
     success_url = f"{host_url}/success?session_id={{CHECKOUT_SESSION_ID}}"
     cancel_url = f"{host_url}/cancel"
     
-    # Initialize Stripe checkout
-    webhook_url = f"{host_url}/api/webhook/stripe"
-    stripe_checkout = StripeCheckout(api_key=stripe_api_key, webhook_url=webhook_url)
+    stripe_checkout = get_stripe_checkout(stripe_webhook_url(host_url))
     
     # Create checkout session
     checkout_request = CheckoutSessionRequest(
@@ -556,7 +1946,10 @@ async def create_checkout_session(request: Request, current_user: User = Depends
         amount=amount,
         currency=currency,
         payment_status="pending",
-        metadata=checkout_request.metadata or {}
+        metadata=checkout_request.metadata or {},
+        url=session.url,
+        host_url=host_url,
+        expires_at=datetime.now(timezone.utc) + timedelta(minutes=CHECKOUT_SESSION_REUSE_MINUTES)
     )
     
     await db.payment_transactions.insert_one(transaction.dict())
@@ -568,30 +1961,51 @@ async def get_payment_status(session_id: str, current_user: User = Depends(get_c
     if not stripe_api_key:
         raise HTTPException(status_code=500, detail="Payment system not configured")
     
-    # Initialize Stripe checkout
-    webhook_url = "http://placeholder"  # Not used for status check
-    stripe_checkout = StripeCheckout(api_key=stripe_api_key, webhook_url=webhook_url)
+    # Terminal states are answered from the database without calling Stripe
+    transaction = await db.payment_transactions.find_one(
+        {"session_id": session_id, "user_id": current_user.id},
+        {"_id": 0, "payment_status": 1, "checkout_status": 1, "amount": 1, "currency": 1, "metadata": 1}
+    )
+    if not transaction:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    status = recorded_checkout_status(transaction)
+    if status:
+        return status
+    
+    # The success page polls repeatedly; concurrent polls share one upstream call
+    poll_key = (current_user.id, session_id)
+    if poll_key in payment_status_inflight:
+        return await asyncio.shield(payment_status_inflight[poll_key])
     
+    future = asyncio.get_running_loop().create_future()
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    payment_status_inflight[poll_key] = future
+    try:
+        status = await fetch_payment_status(session_id, current_user.id)
+        future.set_result(status)
+        return status
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        payment_status_inflight.pop(poll_key, None)
+
+async def fetch_payment_status(session_id: str, user_id: str) -> CheckoutStatusResponse:
     # Get checkout status
-    status = await stripe_checkout.get_checkout_status(session_id)
+    status = await get_stripe_checkout().get_checkout_status(session_id)
     
-    # Update transaction in database
+    # Update transaction in database, keeping the upstream status of terminal states
     if status.payment_status == "paid":
         # Update user to premium
-        await db.users.update_one(
-            {"id": current_user.id},
-            {"$set": {"is_premium": True}}
-        )
-        
-        # Update transaction status
+        await grant_premium(user_id, session_id)
         await db.payment_transactions.update_one(
-            {"session_id": session_id, "user_id": current_user.id},
-            {"$set": {"payment_status": "completed"}}
+            {"session_id": session_id},
+            {"$set": {"checkout_status": status.model_dump()}}
         )
     elif status.status == "expired":
         await db.payment_transactions.update_one(
-            {"session_id": session_id, "user_id": current_user.id},
-            {"$set": {"payment_status": "expired"}}
+            {"session_id": session_id, "user_id": user_id},
+            {"$set": {"payment_status": "expired", "checkout_status": status.model_dump()}}
         )
     
     return status
@@ -601,126 +2015,653 @@ async def stripe_webhook(request: Request):
     if not stripe_api_key:
         raise HTTPException(status_code=500, detail="Payment system not configured")
     
-    webhook_url = "http://placeholder"  # Placeholder for webhook handling
-    stripe_checkout = StripeCheckout(api_key=stripe_api_key, webhook_url=webhook_url)
+    stripe_checkout = get_stripe_checkout()
     
     body = await request.body()
     stripe_signature = request.headers.get("Stripe-Signature")
     
     try:
         webhook_response = await stripe_checkout.handle_webhook(body, stripe_signature)
-        
-        if webhook_response.payment_status == "paid":
-            # Update user to premium based on metadata
-            if webhook_response.metadata and webhook_response.metadata.get("user_id"):
-                user_id = webhook_response.metadata["user_id"]
-                await db.users.update_one(
-                    {"id": user_id},
-                    {"$set": {"is_premium": True}}
-                )
-                
-                # Update transaction status
-                await db.payment_transactions.update_one(
-                    {"session_id": webhook_response.session_id},
-                    {"$set": {"payment_status": "completed"}}
-                )
-        
-        return {"status": "success"}
     except Exception as e:
         logging.error(f"Webhook error: {str(e)}")
         raise HTTPException(status_code=400, detail="Webhook processing failed")
+    
+    # Store the verified event and acknowledge; stripe_event_worker applies it
+    now = datetime.now(timezone.utc)
+    try:
+        await db.stripe_events.insert_one({
+            "event_id": webhook_response.event_id,
+            "event_type": webhook_response.event_type,
+            "session_id": webhook_response.session_id,
+            "payment_status": webhook_response.payment_status,
+            "metadata": webhook_response.metadata or {},
+            "status": "pending",
+            "attempts": 0,
+            "received_at": now,
+            "next_attempt_at": now
+        })
+    except DuplicateKeyError:
+        # Redelivery of an event we already have
+        return {"status": "success"}
+    
+    stripe_event_signal.set()
+    return {"status": "success"}
+
+# Stripe event queue
+STRIPE_EVENT_MAX_ATTEMPTS = int(os.environ.get('STRIPE_EVENT_MAX_ATTEMPTS', 8))
+STRIPE_EVENT_RETRY_BASE_SECONDS = 15
+STRIPE_EVENT_POLL_SECONDS = 30
+STRIPE_EVENT_LEASE_SECONDS = 120
+stripe_event_signal = asyncio.Event()
+
+async def claim_stripe_event() -> Optional[dict]:
+    """Take the oldest due event so transitions are applied in the order Stripe sent them"""
+    now = datetime.now(timezone.utc)
+    return await db.stripe_events.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "processing", "locked_until": {"$lt": now}}
+        ]},
+        {"$set": {"status": "processing", "locked_until": now + timedelta(seconds=STRIPE_EVENT_LEASE_SECONDS)}, "$inc": {"attempts": 1}},
+        sort=[("received_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def apply_stripe_event(event: dict):
+    """Apply an event's state transition; completed transactions are never changed again"""
+    transaction = await db.payment_transactions.find_one(
+        {"session_id": event["session_id"]}, {"_id": 0, "user_id": 1, "payment_status": 1}
+    )
+    if transaction and transaction["payment_status"] == "completed":
+        return
+    
+    if event["payment_status"] == "paid":
+        # Update user to premium based on metadata, falling back to the transaction owner
+        user_id = event["metadata"].get("user_id") or (transaction or {}).get("user_id")
+        if user_id:
+            await grant_premium(user_id, event["session_id"])
+    elif event["event_type"] == "checkout.session.expired":
+        await db.payment_transactions.update_one(
+            {"session_id": event["session_id"], "payment_status": "pending"},
+            {"$set": {"payment_status": "expired"}}
+        )
+
+async def process_stripe_events() -> int:
+    processed = 0
+    while True:
+        event = await claim_stripe_event()
+        if not event:
+            return processed
+        try:
+            await apply_stripe_event(event)
+        except Exception as e:
+            logging.error(f"Error applying Stripe event {event['event_id']}: {str(e)}")
+            if event["attempts"] >= STRIPE_EVENT_MAX_ATTEMPTS:
+                update = {"status": "failed", "last_error": str(e)}
+            else:
+                retry_at = datetime.now(timezone.utc) + timedelta(seconds=STRIPE_EVENT_RETRY_BASE_SECONDS * 2 ** (event["attempts"] - 1))
+                update = {"status": "pending", "next_attempt_at": retry_at, "last_error": str(e)}
+            await db.stripe_events.update_one({"event_id": event["event_id"]}, {"$set": update})
+            continue
+        await db.stripe_events.update_one(
+            {"event_id": event["event_id"]},
+            {"$set": {"status": "applied", "applied_at": datetime.now(timezone.utc)}}
+        )
+        processed += 1
+
+async def stripe_event_worker():
+    """Apply stored Stripe webhook events, woken up as they arrive"""
+    while True:
+        stripe_event_signal.clear()
+        try:
+            await process_stripe_events()
+        except Exception as e:
+            logging.error(f"Error processing Stripe events: {str(e)}")
+        try:
+            await asyncio.wait_for(stripe_event_signal.wait(), timeout=STRIPE_EVENT_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+# Internal metrics endpoints
+def require_metrics_token(x_metrics_token: Optional[str] = Header(None)):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    if x_metrics_token != METRICS_TOKEN:
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+@api_router.get("/internal/llm-stats", dependencies=[Depends(require_metrics_token)])
+async def get_llm_stats():
+    """Latency and token stats per model route"""
+    return {key: stats.to_dict() for key, stats in route_stats.items()}
+
+@api_router.get("/internal/compression-stats", dependencies=[Depends(require_metrics_token)])
+async def get_compression_stats():
+    """Transfer size and compression CPU time per route"""
+    return compression_stats
 
 # User profile endpoint
 @api_router.get("/user/profile", response_model=UserResponse)
-async def get_user_profile(current_user: User = Depends(get_current_user)):
-    return UserResponse(**current_user.dict())
+async def get_user_profile(request: Request, current_user: User = Depends(get_current_user)):
+    etag = user_etag(current_user, "profile", current_user.profile_version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return model_response(user_response(current_user), headers=etag_headers(etag))
 
 @api_router.put("/user/profile", response_model=UserResponse)
 async def update_user_profile(update_data: UserUpdateRequest, current_user: User = Depends(get_current_user)):
     """Update user profile information"""
+    # Only fields sent by the client are updated
+    update_dict = update_data.model_dump(exclude_unset=True, exclude_none=True)
+    if not update_dict:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    
     try:
-        # Build update dictionary with only provided fields
-        update_dict = {}
-        if update_data.age is not None:
-            update_dict["age"] = update_data.age
-        if update_data.weight is not None:
-            update_dict["weight"] = update_data.weight
-        if update_data.height is not None:
-            update_dict["height"] = update_data.height
-        if update_data.goals is not None:
-            update_dict["goals"] = update_data.goals
-        if update_data.dietary_restrictions is not None:
-            update_dict["dietary_restrictions"] = update_data.dietary_restrictions
-        if update_data.workout_type is not None:
-            update_dict["workout_type"] = update_data.workout_type
-        if update_data.current_activities is not None:
-            update_dict["current_activities"] = update_data.current_activities
-        
-        if not update_dict:
-            raise HTTPException(status_code=400, detail="No fields to update")
-        
-        # Update user in database
-        result = await db.users.update_one(
+        updated_user_doc = await db.users.find_one_and_update(
             {"id": current_user.id},
-            {"$set": update_dict}
+            {"$set": update_dict, "$inc": {"profile_version": 1}},
+            projection={"_id": 0, "password": 0},
+            return_document=ReturnDocument.AFTER
         )
-        
-        if result.modified_count == 0:
-            raise HTTPException(status_code=404, detail="User not found or no changes made")
-        
-        # Fetch updated user
-        updated_user_doc = await db.users.find_one({"id": current_user.id})
-        if not updated_user_doc:
-            raise HTTPException(status_code=404, detail="Updated user not found")
-        
-        updated_user = User(**updated_user_doc)
-        return UserResponse(**updated_user.dict())
-        
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error updating profile: {str(e)}")
+    
+    if not updated_user_doc:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    updated_user = user_from_doc(updated_user_doc)
+    on_profile_updated(updated_user)
+    return model_response(user_response(updated_user))
+
+def on_profile_updated(user: User):
+    """Hooks run after a profile change"""
+    user_cache[user.id] = user
+    
+    # Prepare fresh plans for the next dashboard visit
+    enqueue_pregeneration(user.id)
+
+# Feedback admission control
+class SlidingWindowLimiter:
+    """Per-key sliding window of admitted hits kept in memory"""
+    def __init__(self, limit: int, window_seconds: int):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.hits = TTLCache(maxsize=10000, ttl=window_seconds)
+    
+    def retry_after(self, key: str) -> int:
+        """Seconds until key may be admitted again, 0 when it is under the limit"""
+        now = time.monotonic()
+        hits = self.hits.get(key)
+        if hits is None:
+            return 0
+        while hits and hits[0] <= now - self.window_seconds:
+            hits.popleft()
+        if len(hits) < self.limit:
+            return 0
+        return int(hits[0] + self.window_seconds - now) + 1
+    
+    def add(self, key: str):
+        hits = self.hits.get(key) or deque()
+        hits.append(time.monotonic())
+        self.hits[key] = hits  # re-setting refreshes the TTL while the key is active
+
+feedback_limiters = {
+    scope: SlidingWindowLimiter(config["limit"], config["window_seconds"])
+    for scope, config in FEEDBACK_RATE_LIMITS.items()
+}
+recent_feedback_hashes = TTLCache(maxsize=10000, ttl=FEEDBACK_DUPLICATE_WINDOW_SECONDS)
+
+def client_ip(request: Request) -> str:
+    """Client address for rate limiting; leftmost X-Forwarded-For entries are set by the caller and never used"""
+    if TRUST_FORWARDED_FOR:
+        forwarded = [entry.strip() for entry in request.headers.get("x-forwarded-for", "").split(",") if entry.strip()]
+        if len(forwarded) >= TRUSTED_PROXY_HOPS:
+            return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+def feedback_content_hash(feedback: FeedbackRequest) -> str:
+    normalized = " ".join(feedback.message.lower().split())
+    return hashlib.sha256(f"{feedback.email.lower()}\n{normalized}".encode('utf-8')).hexdigest()
+
+def too_many_feedback_requests(retry_after: int):
+    raise HTTPException(
+        status_code=429,
+        detail="Muitos feedbacks enviados. Tente novamente mais tarde.",
+        headers={"Retry-After": str(retry_after)}
+    )
+
+async def shared_retry_after(keys: Dict[str, str]) -> int:
+    """Check the Mongo-backed windows shared by all instances"""
+    now = datetime.now(timezone.utc)
+    for scope, key in keys.items():
+        limiter = feedback_limiters[scope]
+        since = now - timedelta(seconds=limiter.window_seconds)
+        hits = await db.feedback_rate_hits.count_documents({"key": key, "at": {"$gt": since}}, limit=limiter.limit)
+        if hits >= limiter.limit:
+            return limiter.window_seconds
+    return 0
+
+async def admit_feedback(request: Request, feedback: FeedbackRequest) -> str:
+    """Reject throttled or duplicate feedback; returns the content hash of admitted feedback"""
+    keys = {"ip": f"ip:{client_ip(request)}", "email": f"email:{feedback.email.lower()}"}
+    keys = {scope: key for scope, key in keys.items() if scope in feedback_limiters}
+    content_hash = feedback_content_hash(feedback)
+    
+    # In-memory checks first so abusive callers are turned away before any I/O
+    retry_after = max((feedback_limiters[scope].retry_after(key) for scope, key in keys.items()), default=0)
+    if retry_after:
+        too_many_feedback_requests(retry_after)
+    if content_hash in recent_feedback_hashes:
+        raise HTTPException(status_code=409, detail="Este feedback já foi enviado")
+    
+    if FEEDBACK_RATE_STORE == "mongo":
+        retry_after = await shared_retry_after(keys)
+        if retry_after:
+            too_many_feedback_requests(retry_after)
+        since = datetime.now(timezone.utc) - timedelta(seconds=FEEDBACK_DUPLICATE_WINDOW_SECONDS)
+        if await db.feedback.find_one({"content_hash": content_hash, "created_at": {"$gt": since}}, {"_id": 1}):
+            raise HTTPException(status_code=409, detail="Este feedback já foi enviado")
+        now = datetime.now(timezone.utc)
+        await db.feedback_rate_hits.insert_many([{"key": key, "at": now} for key in keys.values()])
+    
+    for scope, key in keys.items():
+        feedback_limiters[scope].add(key)
+    recent_feedback_hashes[content_hash] = True
+    return content_hash
 
 # Feedback endpoint (public - no authentication required)
 @api_router.post("/feedback")
-async def submit_feedback(feedback: FeedbackRequest):
+async def submit_feedback(feedback: FeedbackRequest, request: Request):
     """Submit feedback from users"""
+    content_hash = await admit_feedback(request, feedback)
     try:
-        # Save feedback to database for tracking
+        # Save feedback to the outbox; the email is sent by feedback_outbox_worker
+        now = datetime.now(timezone.utc)
         feedback_doc = feedback.dict()
         feedback_doc["id"] = str(uuid.uuid4())
-        feedback_doc["created_at"] = datetime.now(timezone.utc)
-        feedback_doc["status"] = "pending"
+        feedback_doc["created_at"] = now
+        feedback_doc["status"] = "queued"
+        feedback_doc["attempts"] = 0
+        feedback_doc["next_attempt_at"] = now
+        feedback_doc["digest"] = use_feedback_digest(feedback.rating)
+        feedback_doc["content_hash"] = content_hash
         
         await db.feedback.insert_one(feedback_doc)
-        
-        # Send email
-        email_sent = await send_feedback_email(feedback)
-        
-        if email_sent:
-            # Update status to sent
-            await db.feedback.update_one(
-                {"id": feedback_doc["id"]}, 
-                {"$set": {"status": "sent", "sent_at": datetime.now(timezone.utc)}}
-            )
-            return {
-                "message": "Feedback enviado com sucesso!",
-                "status": "sent",
-                "id": feedback_doc["id"]
-            }
-        else:
-            # Update status to failed
-            await db.feedback.update_one(
-                {"id": feedback_doc["id"]}, 
-                {"$set": {"status": "failed"}}
-            )
-            return {
-                "message": "Feedback salvo, mas houve problema no envio do email.",
-                "status": "saved",
-                "id": feedback_doc["id"]
-            }
-            
     except Exception as e:
+        recent_feedback_hashes.pop(content_hash, None)  # let the caller retry
         logging.error(f"Error processing feedback: {str(e)}")
         raise HTTPException(status_code=500, detail="Erro ao processar feedback")
+    
+    feedback_outbox_event.set()
+    return {
+        "message": "Feedback enviado com sucesso!",
+        "status": "queued",
+        "id": feedback_doc["id"]
+    }
+
+# Feedback outbox
+FEEDBACK_MAX_ATTEMPTS = int(os.environ.get('FEEDBACK_MAX_ATTEMPTS', 5))
+FEEDBACK_RETRY_BASE_SECONDS = int(os.environ.get('FEEDBACK_RETRY_BASE_SECONDS', 30))
+FEEDBACK_OUTBOX_POLL_SECONDS = 30
+FEEDBACK_SEND_LEASE_SECONDS = 300
+feedback_outbox_event = asyncio.Event()
+
+# Digest mode: during bursts feedback is grouped into one email per window or
+# per FEEDBACK_DIGEST_MAX_ITEMS, while low ratings are still sent right away
+FEEDBACK_DIGEST_ENABLED = os.environ.get('FEEDBACK_DIGEST_ENABLED', 'false').lower() == 'true'
+FEEDBACK_DIGEST_WINDOW_SECONDS = int(os.environ.get('FEEDBACK_DIGEST_WINDOW_SECONDS', 900))
+FEEDBACK_DIGEST_MAX_ITEMS = int(os.environ.get('FEEDBACK_DIGEST_MAX_ITEMS', 25))
+FEEDBACK_IMMEDIATE_MAX_RATING = int(os.environ.get('FEEDBACK_IMMEDIATE_MAX_RATING', 2))
+
+def use_feedback_digest(rating: Optional[int]) -> bool:
+    if not FEEDBACK_DIGEST_ENABLED:
+        return False
+    return rating is None or rating > FEEDBACK_IMMEDIATE_MAX_RATING
+
+async def claim_due_feedback() -> Optional[dict]:
+    """Take the next queued feedback (or one left in "sending" by a crashed worker)"""
+    now = datetime.now(timezone.utc)
+    return await db.feedback.find_one_and_update(
+        {"$or": [
+            {"status": "queued", "digest": {"$ne": True}, "next_attempt_at": {"$lte": now}},
+            {"status": "sending", "digest": {"$ne": True}, "locked_until": {"$lt": now}}
+        ]},
+        {"$set": {"status": "sending", "locked_until": now + timedelta(seconds=FEEDBACK_SEND_LEASE_SECONDS)}, "$inc": {"attempts": 1}},
+        sort=[("next_attempt_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def mark_feedback_failed_attempt(feedback: dict, error: Exception):
+    """Retry with exponential backoff until FEEDBACK_MAX_ATTEMPTS is reached"""
+    attempts = feedback.get("attempts", 1)
+    if attempts >= FEEDBACK_MAX_ATTEMPTS:
+        update = {"status": "failed", "last_error": str(error)}
+    else:
+        retry_at = datetime.now(timezone.utc) + timedelta(seconds=FEEDBACK_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+        update = {"status": "queued", "next_attempt_at": retry_at, "last_error": str(error)}
+    await db.feedback.update_one({"id": feedback["id"]}, {"$set": update})
+
+async def deliver_due_feedback() -> int:
+    delivered = 0
+    while True:
+        feedback = await claim_due_feedback()
+        if not feedback:
+            return delivered
+        try:
+            await send_feedback_email(feedback)
+        except Exception as e:
+            logging.error(f"Error sending feedback email {feedback['id']}: {str(e)}")
+            await mark_feedback_failed_attempt(feedback, e)
+            continue
+        await db.feedback.update_one(
+            {"id": feedback["id"]},
+            {"$set": {"status": "sent", "sent_at": datetime.now(timezone.utc)}}
+        )
+        delivered += 1
+
+def build_feedback_digest_message(feedbacks: List[dict]) -> MIMEMultipart:
+    """One email summarising a batch of feedback by rating"""
+    ratings = [f["rating"] for f in feedbacks if f.get("rating") is not None]
+    summary_lines = [f"        {'⭐' * rating} ({rating}): {ratings.count(rating)}" for rating in range(5, 0, -1)]
+    summary_lines.append(f"        Sem avaliação: {len(feedbacks) - len(ratings)}")
+    average = f"{sum(ratings) / len(ratings):.1f}/5" if ratings else "-"
+    
+    entries = "\n".join(
+        f"""
+        👤 {f["name"]} <{f["email"]}> - ⭐ {f.get("rating") if f.get("rating") is not None else "-"} - 📅 {f["created_at"].strftime('%d/%m/%Y às %H:%M')} UTC
+        💬 {f["message"]}
+        """
+        for f in feedbacks
+    )
+    
+    msg = MIMEMultipart()
+    msg['From'] = SMTP_USERNAME if SMTP_USERNAME else 'noreply@fitlife.ai'
+    msg['To'] = FEEDBACK_EMAIL
+    msg['Subject'] = f'Resumo de feedback FitLife AI - {len(feedbacks)} mensagens'
+    
+    body = f"""
+        Resumo de feedback recebido no FitLife AI
+        
+        📊 AVALIAÇÕES (média {average}):
+{chr(10).join(summary_lines)}
+        
+        📝 MENSAGENS:
+        {entries}
+        ---
+        Este email foi enviado automaticamente pelo sistema FitLife AI.
+        """
+    
+    msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+async def take_feedback_digest_batch(query: dict, now: datetime) -> List[dict]:
+    """Move the feedback matching query into a new batch and return what this worker got"""
+    batch_id = str(uuid.uuid4())
+    await db.feedback.update_many(
+        query,
+        {"$set": {"status": "sending", "batch_id": batch_id, "locked_until": now + timedelta(seconds=FEEDBACK_SEND_LEASE_SECONDS)}, "$inc": {"attempts": 1}}
+    )
+    return await db.feedback.find({"batch_id": batch_id, "status": "sending"}, {"_id": 0}) \
+        .sort("created_at", 1).to_list(FEEDBACK_DIGEST_MAX_ITEMS)
+
+async def claim_feedback_digest() -> List[dict]:
+    """Claim a digest batch once it is full or its oldest entry has waited a whole window"""
+    now = datetime.now(timezone.utc)
+    # A batch left in "sending" by a crashed worker is sent again as it is
+    stale = {"status": "sending", "digest": True, "locked_until": {"$lt": now}}
+    stale_batch = await db.feedback.find_one(stale, {"_id": 0, "batch_id": 1})
+    if stale_batch:
+        recovered = await take_feedback_digest_batch({**stale, "batch_id": stale_batch.get("batch_id")}, now)
+        if recovered:
+            return recovered
+    
+    query = {"status": "queued", "digest": True, "next_attempt_at": {"$lte": now}}
+    pending = await db.feedback.find(query, {"_id": 0, "id": 1, "created_at": 1}) \
+        .sort("created_at", 1).limit(FEEDBACK_DIGEST_MAX_ITEMS).to_list(FEEDBACK_DIGEST_MAX_ITEMS)
+    if not pending:
+        return []
+    oldest = pending[0]["created_at"]
+    if oldest.tzinfo is None:
+        oldest = oldest.replace(tzinfo=timezone.utc)
+    if len(pending) < FEEDBACK_DIGEST_MAX_ITEMS and now - oldest < timedelta(seconds=FEEDBACK_DIGEST_WINDOW_SECONDS):
+        return []
+    
+    return await take_feedback_digest_batch({**query, "id": {"$in": [doc["id"] for doc in pending]}}, now)
+
+async def deliver_feedback_digests() -> int:
+    delivered = 0
+    while True:
+        feedbacks = await claim_feedback_digest()
+        if not feedbacks:
+            return delivered
+        try:
+            if smtp_configured():
+                # A single message keeps the whole batch in one SMTP transaction
+                await smtp_connection.send([build_feedback_digest_message(feedbacks)])
+            else:
+                logging.info(f"Feedback digest of {len(feedbacks)} messages (SMTP not configured)")
+        except Exception as e:
+            logging.error(f"Error sending feedback digest: {str(e)}")
+            for feedback in feedbacks:
+                await mark_feedback_failed_attempt(feedback, e)
+            return delivered
+        await db.feedback.update_many(
+            {"id": {"$in": [f["id"] for f in feedbacks]}},
+            {"$set": {"status": "sent", "sent_at": datetime.now(timezone.utc)}}
+        )
+        delivered += len(feedbacks)
+
+async def feedback_outbox_worker():
+    """Deliver queued feedback emails, woken up by new submissions"""
+    while True:
+        feedback_outbox_event.clear()
+        try:
+            await deliver_due_feedback()
+            await deliver_feedback_digests()
+        except Exception as e:
+            logging.error(f"Error processing feedback outbox: {str(e)}")
+        try:
+            await asyncio.wait_for(feedback_outbox_event.wait(), timeout=FEEDBACK_OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+# Retention and archival
+RETENTION_BATCH_SIZE = 500
+
+def archived_suggestion_type(collection: str, doc: dict) -> Optional[str]:
+    if collection == "suggestions":
+        return doc.get("type")
+    return next((name for name, config in SUGGESTION_TYPES.items() if config["collection"] == collection), None)
+
+async def write_archive(collection: str, docs: List[dict], user_id: Optional[str] = None, email: Optional[str] = None):
+    await db.archive.insert_one({
+        "source": collection,
+        "user_id": user_id,
+        "email": email,
+        "ids": [doc.get("id") for doc in docs],
+        "count": len(docs),
+        "data": Binary(zlib.compress(json_util.dumps(docs).encode('utf-8'), 9)),
+        "archived_at": datetime.now(timezone.utc)
+    })
+
+async def archive_batch(collection: str, docs: List[dict], user_id: Optional[str] = None):
+    """Move a batch of documents into the compressed archive"""
+    if collection == "feedback":
+        # Feedback has no user_id; archiving it per email lets account deletion purge it
+        by_email: Dict[str, List[dict]] = {}
+        for doc in docs:
+            by_email.setdefault(doc.get("email"), []).append(doc)
+        for email, email_docs in by_email.items():
+            await write_archive(collection, email_docs, email=email)
+    else:
+        await write_archive(collection, docs, user_id)
+    await db[collection].delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+    
+    # Archived suggestions leave history like deleted ones: out of the buckets and
+    # with a delete entry in history_changes so synced clients drop them too
+    archived_suggestions: Dict[tuple, List[str]] = {}
+    for doc in docs:
+        suggestion_type = archived_suggestion_type(collection, doc)
+        if suggestion_type:
+            archived_suggestions.setdefault((doc["user_id"], suggestion_type), []).append(doc["id"])
+    for (owner_id, suggestion_type), suggestion_ids in archived_suggestions.items():
+        forget_conversation(owner_id, suggestion_type, suggestion_ids)
+        if HISTORY_BUCKETS_ENABLED:
+            bucket_query = {"user_id": owner_id, "type": suggestion_type}
+            await db.suggestion_buckets.update_many(bucket_query, {"$pull": {"entries": {"id": {"$in": suggestion_ids}}}})
+            await db.suggestion_buckets.update_many(bucket_query, [{"$set": {"count": {"$size": "$entries"}}}])
+        for suggestion_id in suggestion_ids:
+            await record_history_change(owner_id, "delete", suggestion_type, suggestion_id)
+
+async def apply_user_retention(collection: str, user_id: str, keep_latest: int, cutoff: datetime, partition: Optional[dict] = None) -> int:
+    """Archive a user's documents that are past their N newest and older than the cutoff"""
+    query = {"user_id": user_id, **(partition or {})}
+    nth_newest = await db[collection].find(query, {"created_at": 1}).sort("created_at", -1).skip(keep_latest - 1).limit(1).to_list(1)
+    if not nth_newest:
+        return 0
+    nth_created_at = nth_newest[0]["created_at"]
+    if nth_created_at.tzinfo is None:
+        nth_created_at = nth_created_at.replace(tzinfo=timezone.utc)
+    older_than = min(nth_created_at, cutoff)
+    
+    archived = 0
+    while True:
+        docs = await db[collection].find({**query, "created_at": {"$lt": older_than}}).limit(RETENTION_BATCH_SIZE).to_list(RETENTION_BATCH_SIZE)
+        if not docs:
+            return archived
+        await archive_batch(collection, docs, user_id)
+        archived += len(docs)
+
+async def apply_retention(collection: str, policy: dict) -> int:
+    cutoff = datetime.now(timezone.utc) - timedelta(days=policy["keep_days"])
+    keep_latest = policy.get("keep_latest")
+    
+    if not keep_latest:
+        archived = 0
+        while True:
+            docs = await db[collection].find({"created_at": {"$lt": cutoff}}).limit(RETENTION_BATCH_SIZE).to_list(RETENTION_BATCH_SIZE)
+            if not docs:
+                return archived
+            await archive_batch(collection, docs)
+            archived += len(docs)
+            await asyncio.sleep(0)
+    
+    # The unified collection keeps keep_latest documents per user and type, like the split ones
+    partitions = [{"type": suggestion_type} for suggestion_type in SUGGESTION_TYPES] if collection == "suggestions" else [{}]
+    
+    # Only users that have documents older than the cutoff can have anything to archive
+    archived = 0
+    for partition in partitions:
+        pipeline = [{"$match": {**partition, "created_at": {"$lt": cutoff}}}, {"$group": {"_id": "$user_id"}}]
+        async for group in db[collection].aggregate(pipeline, allowDiskUse=True):
+            archived += await apply_user_retention(collection, group["_id"], keep_latest, cutoff, partition)
+            await asyncio.sleep(0)
+    return archived
+
+async def retention_worker():
+    """Periodically archive data that falls outside the retention policies"""
+    while True:
+        for collection, policy in RETENTION_POLICIES.items():
+            try:
+                archived = await apply_retention(collection, policy)
+                if archived:
+                    logging.info(f"Retention archived {archived} documents from {collection}")
+            except Exception as e:
+                logging.error(f"Error applying retention to {collection}: {str(e)}")
+        await asyncio.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
+# Account deletion cascade
+# The user document is removed together with an account_deletions record (in a
+# transaction when the deployment supports it); the record drives a batched,
+# concurrent purge of the user's data and is resumed at startup if interrupted.
+PURGE_BATCH_SIZE = int(os.environ.get('PURGE_BATCH_SIZE', 500))
+transactions_supported: Optional[bool] = None
+
+async def supports_transactions() -> bool:
+    """Multi-document transactions need a replica set or a sharded cluster"""
+    global transactions_supported
+    if transactions_supported is None:
+        try:
+            hello = await client.admin.command("hello")
+            transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+        except Exception:
+            transactions_supported = False
+    return transactions_supported
+
+async def delete_user_document(user: User) -> bool:
+    """Delete the user and record the pending purge of their data"""
+    deletion = {
+        "user_id": user.id,
+        "email": user.email,
+        "status": "pending",
+        "requested_at": datetime.now(timezone.utc)
+    }
+    
+    if await supports_transactions():
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                result = await db.users.delete_one({"id": user.id}, session=session)
+                if result.deleted_count == 0:
+                    await session.abort_transaction()
+                    return False
+                await db.account_deletions.insert_one(deletion, session=session)
+                return True
+    
+    # Without transactions, record the purge first; it only runs once the user is gone
+    await db.account_deletions.insert_one(deletion)
+    result = await db.users.delete_one({"id": user.id})
+    if result.deleted_count == 0:
+        await db.account_deletions.delete_one({"_id": deletion["_id"]})
+        return False
+    return True
+
+async def purge_in_batches(collection: str, query: dict) -> int:
+    """Delete matching documents in batches so no single operation runs long"""
+    deleted = 0
+    while True:
+        ids = [doc["_id"] async for doc in db[collection].find(query, {"_id": 1}).limit(PURGE_BATCH_SIZE)]
+        if not ids:
+            return deleted
+        result = await db[collection].delete_many({"_id": {"$in": ids}})
+        deleted += result.deleted_count
+
+async def purge_user_data(user_id: str):
+    """Purge suggestions, transactions and feedback of a deleted account"""
+    deletion = await db.account_deletions.find_one({"user_id": user_id, "status": "pending"})
+    if not deletion or await db.users.find_one({"id": user_id}, {"_id": 1}):
+        return
+    
+    purges = {
+        "workout_suggestions": {"user_id": user_id},
+        "nutrition_suggestions": {"user_id": user_id},
+        "pregenerated_suggestions": {"user_id": user_id},
+        "suggestions": {"user_id": user_id},
+        "history_changes": {"user_id": user_id},
+        "suggestion_buckets": {"user_id": user_id},
+        "archive": {"$or": [{"user_id": user_id}, {"email": deletion["email"]}]},
+        "payment_transactions": {"user_id": user_id},
+        "stripe_events": {"metadata.user_id": user_id},
+        "feedback": {"email": deletion["email"]},
+    }
+    for suggestion_type in SUGGESTION_TYPES:
+        conversation_states.pop((user_id, suggestion_type), None)
+    
+    try:
+        counts = await asyncio.gather(*(purge_in_batches(name, query) for name, query in purges.items()))
+        await db.account_deletions.update_one(
+            {"_id": deletion["_id"]},
+            {"$set": {
+                "status": "completed",
+                "completed_at": datetime.now(timezone.utc),
+                "deleted_counts": dict(zip(purges, counts))
+            }}
+        )
+    except Exception as e:
+        logging.error(f"Error purging data for deleted account {user_id}: {str(e)}")
+
+async def resume_pending_purges():
+    """Restart purges interrupted by a restart"""
+    async for deletion in db.account_deletions.find({"status": "pending"}, {"user_id": 1}):
+        await purge_user_data(deletion["user_id"])
 
 @api_router.post("/user/delete-account")
 async def delete_user_account_with_confirmation(
@@ -743,37 +2684,232 @@ async def delete_user_account_with_confirmation(
         raise HTTPException(status_code=400, detail="Confirmation text incorrect")
     
     try:
-        # Delete user's workout suggestions
-        workout_deleted = await db.workout_suggestions.delete_many({"user_id": current_user.id})
-        
-        # Delete user's nutrition suggestions
-        nutrition_deleted = await db.nutrition_suggestions.delete_many({"user_id": current_user.id})
+        # Remove the account right away; the user's data is purged in the background
+        user_deleted = await delete_user_document(current_user)
+        invalidate_cached_user(current_user.id)
+    except Exception as e:
+        logging.error(f"Error deleting user account {current_user.id}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Erro ao excluir conta")
+    
+    if not user_deleted:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    start_background_task(purge_user_data(current_user.id))
+    
+    return {
+        "message": "Conta excluída com sucesso",
+        "deleted_data": {
+            "user_account": True,
+            "related_data": "scheduled"
+        }
+    }
+
+# Response compression middleware
+# Negotiates br (when the brotli package is installed) or gzip for JSON, NDJSON,
+# SSE and text responses. Buffered bodies are compressed above
+# COMPRESSION_MIN_SIZE; streamed bodies are compressed chunk by chunk with a flush
+# so NDJSON/SSE consumers still see every chunk immediately. Bodies carrying a
+# strong ETag never change, so their compressed bytes are cached and reused.
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+compressed_body_cache = LRUCache(maxsize=int(os.environ.get('COMPRESSION_CACHE_ENTRIES', 1000)))
+COMPRESSION_CACHE_MAX_BODY = 256 * 1024
+compression_stats: Dict[str, dict] = {}
+
+ETAG_CODING_SUFFIXES = ("-gzip", "-br")
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """Distinct strong validator for a content-coded body; weak ETags are left as they are"""
+    if not etag.startswith('"'):
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+def identity_etag(etag: str) -> str:
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    for suffix in ETAG_CODING_SUFFIXES:
+        if etag.endswith(f'{suffix}"'):
+            return f'{etag[:-len(suffix) - 1]}"'
+    return etag
+
+class StreamCompressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        else:
+            self.compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+    
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+def record_compression(scope, raw_bytes: int, sent_bytes: int, cpu_seconds: float, cache_hit: bool = False):
+    route = scope.get("route")
+    key = getattr(route, "path", None) or scope.get("path", "")
+    stats = compression_stats.setdefault(key, {"responses": 0, "cache_hits": 0, "raw_bytes": 0, "sent_bytes": 0, "compression_ms": 0.0})
+    stats["responses"] += 1
+    stats["cache_hits"] += int(cache_hit)
+    stats["raw_bytes"] += raw_bytes
+    stats["sent_bytes"] += sent_bytes
+    stats["compression_ms"] = round(stats["compression_ms"] + cpu_seconds * 1000, 3)
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope["headers"]}
+        encoding = negotiate_encoding(headers.get("accept-encoding", ""))
+        if_none_match = headers.get("if-none-match", "")
+        if encoding is None and not if_none_match:
+            await self.app(scope, receive, send)
+            return
         
-        # Delete user's payment transactions
-        transactions_deleted = await db.payment_transactions.delete_many({"user_id": current_user.id})
+        state = {"start": None, "compressor": None, "passthrough": False, "drain": False,
+                 "raw": 0, "sent": 0, "cpu": 0.0, "chunks": [], "cache_key": None}
         
-        # Finally, delete the user account
-        user_deleted = await db.users.delete_one({"id": current_user.id})
+        async def send_compressed(message):
+            if message["type"] == "http.response.start":
+                response_headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in message["headers"]}
+                content_type = response_headers.get("content-type", "")
+                if message["status"] == 304:
+                    # The 200 may have been sent uncompressed (below minimum_size) or with another
+                    # coding, so answer with the validator the client holds rather than guessing
+                    state["passthrough"] = True
+                    await send({**message, "headers": self.revalidated_headers(message["headers"], if_none_match)})
+                    return
+                if encoding is None or "content-encoding" in response_headers or not content_type.startswith(COMPRESSIBLE_TYPES):
+                    state["passthrough"] = True
+                    await send(message)
+                    return
+                if response_headers.get("etag", "").startswith('"'):
+                    state["cache_key"] = encoded_etag(response_headers["etag"], encoding)
+                state["start"] = message
+                return
+            
+            if state["passthrough"] or message["type"] != "http.response.body":
+                await send(message)
+                return
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            start = state["start"]
+            
+            if state["compressor"] is None:
+                cached = compressed_body_cache.get(state["cache_key"]) if state["cache_key"] else None
+                if cached is not None:
+                    # Same strong ETag, same bytes: skip compression and drop the app's body
+                    await send({**start, "headers": self.compressed_headers(start, encoding, len(cached))})
+                    await send({"type": "http.response.body", "body": cached})
+                    record_compression(scope, 0, len(cached), 0.0, cache_hit=True)
+                    state["drain"] = True
+                    return
+                
+                if not more_body and len(body) < self.minimum_size:
+                    await send(start)
+                    await send(message)
+                    state["passthrough"] = True
+                    return
+                
+                state["compressor"] = StreamCompressor(encoding)
+                if not more_body:
+                    started = time.perf_counter()
+                    compressed = state["compressor"].compress(body) + state["compressor"].finish()
+                    cpu = time.perf_counter() - started
+                    await send({**start, "headers": self.compressed_headers(start, encoding, len(compressed))})
+                    await send({"type": "http.response.body", "body": compressed})
+                    if state["cache_key"] and len(compressed) <= COMPRESSION_CACHE_MAX_BODY:
+                        compressed_body_cache[state["cache_key"]] = compressed
+                    record_compression(scope, len(body), len(compressed), cpu)
+                    return
+                await send({**start, "headers": self.compressed_headers(start, encoding, None)})
+            
+            started = time.perf_counter()
+            chunk = state["compressor"].compress(body) if body else b""
+            if not more_body:
+                chunk += state["compressor"].finish()
+            state["cpu"] += time.perf_counter() - started
+            state["raw"] += len(body)
+            state["sent"] += len(chunk)
+            if state["cache_key"]:
+                state["chunks"].append(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+            
+            if not more_body:
+                if state["cache_key"] and state["sent"] <= COMPRESSION_CACHE_MAX_BODY:
+                    compressed_body_cache[state["cache_key"]] = b"".join(state["chunks"])
+                record_compression(scope, state["raw"], state["sent"], state["cpu"])
         
-        if user_deleted.deleted_count == 0:
-            raise HTTPException(status_code=404, detail="User not found")
+        async def send_wrapper(message):
+            if not state["drain"]:
+                await send_compressed(message)
         
-        return {
-            "message": "Conta excluída com sucesso",
-            "deleted_data": {
-                "user_account": user_deleted.deleted_count > 0,
-                "workout_suggestions": workout_deleted.deleted_count,
-                "nutrition_suggestions": nutrition_deleted.deleted_count,
-                "payment_transactions": transactions_deleted.deleted_count
-            }
-        }
-    except Exception as e:
-        logging.error(f"Error deleting user account {current_user.id}: {str(e)}")
-        raise HTTPException(status_code=500, detail="Erro ao excluir conta")
+        await self.app(scope, receive, send_wrapper)
+    
+    @staticmethod
+    def rewrite_etag(headers, encoding: str):
+        return [
+            (key, encoded_etag(value.decode('latin-1'), encoding).encode('latin-1')) if key.lower() == b"etag" else (key, value)
+            for key, value in headers
+        ]
+    
+    @staticmethod
+    def revalidated_headers(headers, if_none_match: str):
+        candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+        result = []
+        for key, value in headers:
+            if key.lower() == b"etag":
+                etag = value.decode('latin-1')
+                held = next((candidate for candidate in candidates
+                             if candidate.startswith('"') and identity_etag(candidate) == identity_etag(etag)), None)
+                if held and etag.startswith('"'):
+                    value = held.encode('latin-1')
+            result.append((key, value))
+        return result
+    
+    @classmethod
+    def compressed_headers(cls, start, encoding: str, content_length: Optional[int]):
+        original_headers = cls.rewrite_etag(start["headers"], encoding)
+        headers = [(key, value) for key, value in original_headers if key.lower() not in (b"content-length", b"vary")]
+        vary = [value for key, value in original_headers if key.lower() == b"vary"]
+        headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+        headers.append((b"content-encoding", encoding.encode('latin-1')))
+        if content_length is not None:
+            headers.append((b"content-length", str(content_length).encode('latin-1')))
+        return headers
 
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(CompressionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -789,6 +2925,136 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Mongo error codes raised by create_index
+DUPLICATE_KEY = 11000
+INDEX_OPTIONS_CONFLICT = 85
+
+def index_label(collection, keys) -> str:
+    fields = [keys] if isinstance(keys, str) else [field for field, _ in keys]
+    return f"{collection.name}({', '.join(fields)})"
+
+async def report_duplicates(collection, field: str, limit: int = 20):
+    """Log the values that stop a unique index on field from being built"""
+    duplicates = await collection.aggregate([
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": limit},
+    ]).to_list(limit)
+    if duplicates:
+        values = ", ".join(f"{duplicate['_id']!r} x{duplicate['count']}" for duplicate in duplicates)
+        logging.error(f"Duplicate {collection.name}.{field} values block the unique index (first {limit}): {values}")
+
+async def ensure_index(collection, keys, **options) -> bool:
+    """Create one index, returning False instead of raising so the other indexes still get built"""
+    try:
+        try:
+            await collection.create_index(keys, **options)
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT or "expireAfterSeconds" not in options:
+                raise
+            # create_index can't change the TTL of an existing index; collMod can
+            key_pattern = {keys: 1} if isinstance(keys, str) else dict(keys)
+            await collection.database.command("collMod", collection.name,
+                                              index={"keyPattern": key_pattern, "expireAfterSeconds": options["expireAfterSeconds"]})
+            logging.info(f"Updated TTL of index {index_label(collection, keys)} to {options['expireAfterSeconds']}s")
+        return True
+    except Exception as e:
+        logging.error(f"Error creating index {index_label(collection, keys)}: {str(e)}")
+        if getattr(e, "code", None) == DUPLICATE_KEY and isinstance(keys, str):
+            try:
+                await report_duplicates(collection, keys)
+            except Exception as report_error:
+                logging.error(f"Error looking up duplicate {collection.name}.{keys} values: {str(report_error)}")
+        return False
+
+async def create_indexes():
+    """Create every index on its own; raise if a unique index the code relies on could not be built"""
+    # Duplicate checks, idempotent replays, webhook dedup, dictionary ids and history sync sequence numbers depend on these
+    required = [
+        (db.users, "email"),
+        (db.users, "id"),
+        (db.idempotency_keys, "key"),
+        (db.codec_dictionaries, "dict_id"),
+        (db.stripe_events, "event_id"),
+        (db.suggestions, "id"),
+        (db.history_changes, [("user_id", 1), ("seq", 1)]),
+    ]
+    missing = [index_label(collection, keys) for collection, keys in required
+               if not await ensure_index(collection, keys, unique=True)]
+    
+    await ensure_index(db.idempotency_keys, "expires_at", expireAfterSeconds=0)
+    await ensure_index(db.account_deletions, [("status", 1), ("user_id", 1)])
+    await ensure_index(db.users, [("access_state", 1), ("access_until", 1)])
+    await ensure_index(db.payment_transactions, "session_id")
+    await ensure_index(db.payment_transactions, [("user_id", 1), ("payment_status", 1), ("expires_at", -1)])
+    await ensure_index(db.stripe_events, [("status", 1), ("received_at", 1)])
+    for config in SUGGESTION_TYPES.values():
+        await ensure_index(db[config["collection"]], [("user_id", 1), ("created_at", -1)])
+        await ensure_index(db[config["collection"]], "id")
+    await ensure_index(db.suggestion_buckets, [("user_id", 1), ("type", 1), ("month", -1)])
+    await ensure_index(db.suggestions, [("user_id", 1), ("type", 1), ("created_at", -1)])
+    await ensure_index(db.suggestions, [("user_id", 1), ("created_at", -1)])
+    await ensure_index(db.history_changes, "created_at", expireAfterSeconds=HISTORY_CHANGES_TTL_DAYS * 86400)
+    await ensure_index(db.feedback, "created_at")
+    await ensure_index(db.feedback, [("status", 1), ("next_attempt_at", 1)])
+    await ensure_index(db.feedback, [("content_hash", 1), ("created_at", -1)])
+    await ensure_index(db.feedback_rate_hits, [("key", 1), ("at", -1)])
+    rate_window = max((config["window_seconds"] for config in FEEDBACK_RATE_LIMITS.values()), default=3600)
+    await ensure_index(db.feedback_rate_hits, "at", expireAfterSeconds=rate_window)
+    await ensure_index(db.archive, [("source", 1), ("user_id", 1)])
+    await ensure_index(db.archive, "user_id")
+    await ensure_index(db.archive, "email")
+    if ARCHIVE_TTL_DAYS:
+        await ensure_index(db.archive, "archived_at", expireAfterSeconds=ARCHIVE_TTL_DAYS * 86400)
+    await ensure_index(db.llm_generations, "created_at", expireAfterSeconds=LLM_GENERATIONS_TTL_DAYS * 86400)
+    await ensure_index(db.pregenerated_suggestions, [("user_id", 1), ("type", 1)])
+    await ensure_index(db.pregenerated_suggestions, "created_at", expireAfterSeconds=PREGEN_TTL_DAYS * 86400)
+    
+    if missing:
+        raise RuntimeError(f"Required unique indexes could not be built: {', '.join(missing)}")
+
+@app.on_event("startup")
+async def start_background_workers():
+    global HISTORY_READ_LAYOUT
+    if HISTORY_READ_LAYOUT == "buckets" and not HISTORY_BUCKETS_ENABLED:
+        # Buckets are only kept in sync while HISTORY_BUCKETS_ENABLED; reading them otherwise serves stale history
+        logging.warning("HISTORY_READ_LAYOUT=buckets needs HISTORY_BUCKETS_ENABLED=true, reading the documents layout")
+        HISTORY_READ_LAYOUT = "documents"
+    if brotli is None:
+        logging.warning("brotli is not installed, responses are compressed with gzip only")
+    check_suggestion_codec()
+    
+    # Refuse to serve without the unique indexes; the other index failures are only logged
+    await create_indexes()
+    
+    start_background_task(resume_pending_purges())
+    start_background_task(entitlement_sweeper())
+    start_background_task(feedback_outbox_worker())
+    if stripe_api_key:
+        get_stripe_checkout()
+        if PUBLIC_BASE_URL:
+            get_stripe_checkout(stripe_webhook_url(PUBLIC_BASE_URL))
+        start_background_task(stripe_event_worker())
+    
+    if zstandard is not None:
+        try:
+            await load_zstd_dictionaries()
+        except Exception as e:
+            logging.error(f"Error loading zstd dictionaries: {str(e)}")
+    if SUGGESTION_CODEC_MIGRATE:
+        start_background_task(migrate_suggestion_codec())
+    if SUGGESTIONS_UNIFIED_MIGRATE:
+        start_background_task(migrate_to_unified_collection())
+    if RETENTION_ENABLED:
+        start_background_task(retention_worker())
+    if PREGEN_ENABLED:
+        start_background_task(pregeneration_worker())
+        start_background_task(nightly_pregeneration_batch())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in list(background_tasks):
+        task.cancel()
+    await smtp_connection.close()
     client.close()
\ No newline at end of file
@@ -68,7 +68,8 @@ self.addEventListener('fetch', (event) => {
       fetch(request)
         .then((response) => {
           // Only cache GET requests with successful responses
-          if (request.method === 'GET' && response.status === 200) {
+          // (history sync responses are deltas, caching them would replay stale changes)
+          if (request.method === 'GET' && response.status === 200 && url.pathname !== '/api/history/sync') {
             const responseClone = response.clone();
             caches.open(API_CACHE_NAME)
               .then((cache) => {
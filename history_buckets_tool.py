@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Migrate suggestion history into monthly buckets and benchmark both history summary layouts
+
+Usage:
+    python history_buckets_tool.py migrate
+    python history_buckets_tool.py benchmark [users]
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+import server  # noqa: E402  (loads backend/.env and connects to MongoDB)
+
+async def migrate():
+    """Rebuild suggestion_buckets from the suggestion collections"""
+    print("🔄 Building history buckets...")
+    started = time.perf_counter()
+    buckets = await server.migrate_history_to_buckets()
+    print(f"✅ {buckets} buckets written in {time.perf_counter() - started:.1f}s")
+    return True
+
+async def benchmark(users: int):
+    """Time history summary reads with the documents and buckets layouts for a sample of users"""
+    collection, type_query = server.suggestion_source("workout")
+    user_ids = [doc["_id"] async for doc in collection.aggregate([
+        {"$match": type_query},
+        {"$group": {"_id": "$user_id"}},
+        {"$sample": {"size": users}}
+    ])]
+    if not user_ids:
+        print("❌ No users with history found")
+        return False
+    
+    print(f"🔍 Benchmarking history summary reads for {len(user_ids)} users")
+    for layout in ("documents", "buckets"):
+        timings = []
+        for user_id in user_ids:
+            for suggestion_type in server.SUGGESTION_TYPES:
+                started = time.perf_counter()
+                await server.find_history_summaries(suggestion_type, user_id, layout=layout)
+                timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        print(f"   {layout:<10} p50 {timings[len(timings) // 2]:.1f}ms   "
+              f"p95 {timings[min(len(timings) - 1, int(len(timings) * 0.95))]:.1f}ms")
+    return True
+
+async def main():
+    try:
+        command = sys.argv[1] if len(sys.argv) > 1 else "benchmark"
+        if command == "migrate":
+            return await migrate()
+        if command == "benchmark":
+            return await benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 50)
+        print(__doc__)
+        return False
+    finally:
+        server.client.close()
+
+if __name__ == "__main__":
+    result = asyncio.run(main())
+    exit(0 if result else 1)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Minimal SMTP server that accepts every message and prints it, for testing the
+feedback outbox without a real mail provider
+
+Usage:
+    python local_smtp_sink.py [port]
+
+Then start the backend with:
+    SMTP_SERVER=localhost SMTP_PORT=1025 SMTP_STARTTLS=false SMTP_NO_AUTH=true
+"""
+
+import asyncio
+import sys
+
+async def handle_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Speak just enough SMTP (EHLO, MAIL, RCPT, DATA, RSET, NOOP, QUIT) for aiosmtplib"""
+    peer = writer.get_extra_info("peername")
+    writer.write(b"220 localhost FitLife SMTP sink\r\n")
+    await writer.drain()
+    messages = 0
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode(errors="replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                writer.write(b"250-localhost\r\n250 8BITMIME\r\n")
+            elif verb in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                writer.write(b"250 OK\r\n")
+            elif verb == "DATA":
+                writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                await writer.drain()
+                body = []
+                while True:
+                    data_line = await reader.readline()
+                    if not data_line or data_line in (b".\r\n", b".\n"):
+                        break
+                    body.append(data_line.decode(errors="replace"))
+                messages += 1
+                print(f"📧 Message {messages} from {peer}:")
+                print("".join(body))
+                writer.write(b"250 OK: queued\r\n")
+            elif verb == "QUIT":
+                writer.write(b"221 Bye\r\n")
+                await writer.drain()
+                break
+            else:
+                writer.write(b"502 Command not implemented\r\n")
+            await writer.drain()
+    finally:
+        writer.close()
+        print(f"🔌 {peer} disconnected after {messages} messages")
+
+async def main(port: int):
+    server = await asyncio.start_server(handle_session, "127.0.0.1", port)
+    print(f"🚀 SMTP sink listening on 127.0.0.1:{port}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 1025
+    try:
+        asyncio.run(main(port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Compare prompt variants using the generations recorded in llm_generations
+"""
+
+import asyncio
+import sys
+from motor.motor_asyncio import AsyncIOMotorClient
+import os
+from dotenv import load_dotenv
+from pathlib import Path
+from datetime import datetime, timezone, timedelta
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+async def prompt_experiment_report(days: int):
+    """Print latency, output length and token stats per suggestion type and variant"""
+    client = None
+    try:
+        # Load environment variables
+        ROOT_DIR = Path(__file__).parent / "backend"
+        load_dotenv(ROOT_DIR / '.env')
+        
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        
+        since = datetime.now(timezone.utc) - timedelta(days=days)
+        print(f"🔍 Prompt variants in the last {days} days")
+        
+        groups = {}
+        cursor = db.llm_generations.find(
+            {"created_at": {"$gte": since}, "variant": {"$exists": True}},
+            {"_id": 0, "suggestion_type": 1, "variant": 1, "latency_ms": 1, "prompt_tokens": 1,
+             "output_tokens": 1, "output_chars": 1, "error": 1}
+        )
+        async for generation in cursor:
+            key = (generation.get("suggestion_type", "?"), generation["variant"])
+            groups.setdefault(key, []).append(generation)
+        
+        if not groups:
+            print("❌ No generations with a variant recorded")
+            return False
+        
+        print(f"\n{'type':<10} {'variant':<10} {'calls':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} "
+              f"{'chars':>7} {'in tok':>7} {'out tok':>7}")
+        for (suggestion_type, variant), generations in sorted(groups.items()):
+            ok = [g for g in generations if not g.get("error")]
+            latencies = [g["latency_ms"] for g in ok]
+            avg = lambda field: sum(g.get(field, 0) for g in ok) / len(ok) if ok else 0
+            print(f"{suggestion_type:<10} {variant:<10} {len(generations):>6} {len(generations) - len(ok):>6} "
+                  f"{percentile(latencies, 0.5):>8.0f} {percentile(latencies, 0.95):>8.0f} "
+                  f"{avg('output_chars'):>7.0f} {avg('prompt_tokens'):>7.0f} {avg('output_tokens'):>7.0f}")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Error building report: {str(e)}")
+        return False
+    finally:
+        if client:
+            client.close()
+
+if __name__ == "__main__":
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    result = asyncio.run(prompt_experiment_report(days))
+    exit(0 if result else 1)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of response serialization and model cost per endpoint, before and
+after the fast JSON path (ORJSONResponse, single validation, streamed history,
+model_construct read models)
+
+Usage:
+    python serialization_benchmark.py [iterations]
+"""
+
+import asyncio
+import os
+import sys
+import timeit
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import List
+
+# Importing the server only builds the Mongo client, it does not connect
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "fitlife_benchmark")
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse, ORJSONResponse  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+import server  # noqa: E402
+
+SAMPLE_TEXT = ("💪 TREINO PRINCIPAL\n\nAgachamento livre: 4 séries x 12 repetições, descanso de 60 segundos.\n\n" * 40)
+
+def sample_user_doc() -> dict:
+    user = server.User(
+        email="benchmark@fitlife.ai", name="Benchmark", age=30, weight=75.5, height=178,
+        goals="Ganhar massa muscular", dietary_restrictions="Sem lactose", workout_type="academia"
+    )
+    return {**user.model_dump(), "password": "hash", "_id": "object-id"}
+
+def sample_history_docs() -> List[dict]:
+    now = datetime.now(timezone.utc)
+    return [
+        {"id": str(uuid.uuid4()), "user_id": "user", "suggestion": SAMPLE_TEXT, "created_at": now - timedelta(days=i)}
+        for i in range(20)
+    ]
+
+def auth_before(user_doc):
+    payload = {"message": "Login successful", "token": "token", "user": server.UserResponse(**user_doc)}
+    return JSONResponse(jsonable_encoder(payload)).body
+
+auth_adapter = TypeAdapter(server.AuthResponse)
+
+def auth_after(user_doc):
+    payload = {"message": "Login successful", "token": "token", "user": user_doc}
+    return ORJSONResponse(auth_adapter.dump_python(auth_adapter.validate_python(payload), mode="json")).body
+
+history_adapter = TypeAdapter(List[server.WorkoutSuggestion])
+
+def history_before(docs):
+    suggestions = [server.WorkoutSuggestion(**doc) for doc in docs]
+    validated = history_adapter.validate_python([suggestion.model_dump() for suggestion in suggestions])
+    return JSONResponse(jsonable_encoder(validated)).body
+
+async def collect(docs):
+    return b"".join([chunk async for chunk in server.iter_json(server.iter_list(docs), server.SUGGESTION_FIELDS, False)])
+
+# One loop for every iteration, so loop setup is not part of the measured cost
+benchmark_loop = asyncio.new_event_loop()
+
+def history_after(docs):
+    return benchmark_loop.run_until_complete(collect(docs))
+
+profile_adapter = TypeAdapter(server.UserResponse)
+
+def profile_before(user_doc):
+    response = server.UserResponse(**server.User(**user_doc).dict())
+    return JSONResponse(jsonable_encoder(profile_adapter.validate_python(response.model_dump()))).body
+
+def profile_after(user_doc):
+    return server.model_response(server.user_response(server.user_from_doc(user_doc))).body
+
+def current_user_before(user_doc):
+    return server.User(**user_doc)
+
+def current_user_after(user_doc):
+    return server.user_from_doc(user_doc)
+
+def run(iterations: int):
+    user_doc = sample_user_doc()
+    history_docs = sample_history_docs()
+    projected_user_doc = {key: value for key, value in user_doc.items() if key not in ("password", "_id")}
+    cases = [
+        ("POST /auth/login", auth_before, auth_after, user_doc),
+        ("GET /history/workouts", history_before, history_after, history_docs),
+        ("GET /user/profile", profile_before, profile_after, user_doc),
+        ("get_current_user", current_user_before, current_user_after, projected_user_doc),
+    ]
+    
+    print(f"🔍 Serialization cost per response ({iterations} iterations, orjson {'on' if server.orjson else 'off'})")
+    print(f"   {'endpoint':<24} {'before µs':>10} {'after µs':>10} {'speedup':>8}")
+    for name, before, after, argument in cases:
+        before_us = timeit.timeit(lambda: before(argument), number=iterations) / iterations * 1e6
+        after_us = timeit.timeit(lambda: after(argument), number=iterations) / iterations * 1e6
+        print(f"   {name:<24} {before_us:>10.1f} {after_us:>10.1f} {before_us / after_us:>7.1f}x")
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,8 @@
+import os
+import sys
+from pathlib import Path
+
+# Importing the server only builds the Mongo client, it does not connect
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "fitlife_test")
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
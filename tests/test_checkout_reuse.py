@@ -0,0 +1,78 @@
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+
+HOST = "https://fitlife.example.com"
+USER = server.User(id="u1", email="ana@example.com", name="Ana", age=30, weight=60, height=165, goals="Saúde")
+
+def matches(doc, query):
+    for field, condition in query.items():
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            if "$gt" in condition and not (value is not None and value > condition["$gt"]):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+class FakeTransactions:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def find_one(self, query, projection=None, sort=None):
+        found = [doc for doc in self.docs if matches(doc, query)]
+        for field, direction in reversed(sort or []):
+            found.sort(key=lambda doc: doc[field], reverse=direction == -1)
+        return dict(found[0]) if found else None
+
+class FakeDb:
+    def __init__(self, docs):
+        self.payment_transactions = FakeTransactions(docs)
+
+def transaction(session_id, minutes_left=30, **fields):
+    return {
+        "session_id": session_id,
+        "url": f"https://checkout.stripe.com/{session_id}",
+        "user_id": "u1",
+        "payment_status": "pending",
+        "host_url": HOST,
+        "expires_at": datetime.now(timezone.utc) + timedelta(minutes=minutes_left),
+        **fields,
+    }
+
+def open_session(monkeypatch, docs, host_url=HOST, user_id="u1"):
+    monkeypatch.setattr(server, "db", FakeDb(docs))
+    return asyncio.run(server.find_open_checkout_session(host_url, user_id))
+
+def test_pending_session_is_reused(monkeypatch):
+    session = open_session(monkeypatch, [transaction("cs_1")])
+    assert session.session_id == "cs_1"
+    assert session.url == "https://checkout.stripe.com/cs_1"
+
+def test_session_expiring_last_is_reused(monkeypatch):
+    session = open_session(monkeypatch, [transaction("cs_1", 10), transaction("cs_2", 50), transaction("cs_3", 30)])
+    assert session.session_id == "cs_2"
+
+@pytest.mark.parametrize("doc, host_url, user_id", [
+    (transaction("cs_1", minutes_left=-1), HOST, "u1"),
+    (transaction("cs_1", payment_status="completed"), HOST, "u1"),
+    (transaction("cs_1", payment_status="expired"), HOST, "u1"),
+    # Success and cancel URLs point at the host the session was created for
+    (transaction("cs_1"), "https://other.example.com", "u1"),
+    (transaction("cs_1"), HOST, "u2"),
+    (transaction("cs_1", url=None), HOST, "u1"),
+])
+def test_sessions_that_cannot_be_completed_are_not_reused(monkeypatch, doc, host_url, user_id):
+    assert open_session(monkeypatch, [doc], host_url, user_id) is None
+
+def test_checkout_returns_the_open_session_without_calling_stripe(monkeypatch):
+    monkeypatch.setattr(server, "db", FakeDb([transaction("cs_1")]))
+
+    def get_stripe_checkout(*args, **kwargs):
+        raise AssertionError("a new Stripe session was created")
+
+    monkeypatch.setattr(server, "get_stripe_checkout", get_stripe_checkout)
+    assert asyncio.run(server.start_checkout_session(HOST, USER)).session_id == "cs_1"
@@ -0,0 +1,125 @@
+import gzip
+
+import pytest
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import server
+
+ETAG = '"u1:history:workout:json:5"'
+
+def make_request(headers: dict) -> Request:
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "path": "/",
+        "headers": [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in headers.items()],
+    })
+
+def history(request):
+    if server.etag_matches(request, ETAG):
+        return Response(status_code=304, headers={"ETag": ETAG})
+    return JSONResponse({"suggestion": "a" * 5000}, headers={"ETag": ETAG})
+
+def small(request):
+    return JSONResponse({"ok": True})
+
+def empty_history(request):
+    etag = '"u1:history:workout:json:0"'
+    if server.etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse([], headers={"ETag": etag})
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, "compressed_body_cache", server.LRUCache(maxsize=10))
+    monkeypatch.setattr(server, "compression_stats", {})
+    app = Starlette(routes=[Route("/history", history), Route("/small", small), Route("/empty", empty_history)])
+    return TestClient(server.CompressionMiddleware(app))
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    ("", None),
+    ("identity", None),
+    ("gzip", "gzip"),
+    ("gzip;q=0, deflate", None),
+    ("deflate, gzip;q=0.5", "gzip"),
+    ("GZIP", "gzip"),
+    ("gzip;q=abc", None),
+])
+def test_negotiate_encoding(accept_encoding, expected):
+    assert server.negotiate_encoding(accept_encoding) == expected
+
+def test_negotiate_encoding_prefers_brotli_when_available():
+    pytest.importorskip("brotli")
+    assert server.negotiate_encoding("gzip, br") == "br"
+
+def test_encoded_etag_only_rewrites_strong_validators():
+    assert server.encoded_etag('"abc"', "gzip") == '"abc-gzip"'
+    assert server.encoded_etag('W/"abc"', "br") == 'W/"abc"'
+    assert server.identity_etag('"abc-gzip"') == '"abc"'
+    assert server.identity_etag('W/"abc-br"') == '"abc"'
+    assert server.identity_etag('"abc"') == '"abc"'
+
+@pytest.mark.parametrize("if_none_match, expected", [
+    (None, False),
+    (ETAG, True),
+    (server.encoded_etag(ETAG, "gzip"), True),
+    (f"W/{ETAG}", True),
+    ('"other", ' + ETAG, True),
+    ("*", True),
+    ('"other"', False),
+])
+def test_etag_matches(if_none_match, expected):
+    headers = {"If-None-Match": if_none_match} if if_none_match else {}
+    assert server.etag_matches(make_request(headers), ETAG) is expected
+
+def test_gzip_response_gets_its_own_etag(client):
+    response = client.get("/history", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"] == '"u1:history:workout:json:5-gzip"'
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert response.json() == {"suggestion": "a" * 5000}
+
+def test_identity_response_keeps_the_original_etag(client):
+    response = client.get("/history", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+    assert response.headers["etag"] == ETAG
+
+def test_cached_compressed_body_is_reused(client):
+    first = client.get("/history", headers={"Accept-Encoding": "gzip"})
+    second = client.get("/history", headers={"Accept-Encoding": "gzip"})
+    assert first.content == second.content
+    assert list(server.compressed_body_cache.keys()) == ['"u1:history:workout:json:5-gzip"']
+    assert server.compression_stats["/history"]["cache_hits"] == 1
+
+def test_revalidation_with_compressed_etag_returns_304_with_the_same_etag(client):
+    etag = client.get("/history", headers={"Accept-Encoding": "gzip"}).headers["etag"]
+    response = client.get("/history", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+def test_revalidation_of_an_uncompressed_response_keeps_its_etag(client):
+    first = client.get("/empty", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in first.headers
+    response = client.get("/empty", headers={"Accept-Encoding": "gzip", "If-None-Match": first.headers["etag"]})
+    assert response.status_code == 304
+    assert response.headers["etag"] == first.headers["etag"]
+
+def test_revalidation_without_accept_encoding_keeps_the_held_etag(client):
+    etag = client.get("/history", headers={"Accept-Encoding": "gzip"}).headers["etag"]
+    response = client.get("/history", headers={"Accept-Encoding": "identity", "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+def test_small_responses_are_not_compressed(client):
+    response = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+    assert response.json() == {"ok": True}
+
+def test_stream_compressor_output_is_valid_gzip():
+    compressor = server.StreamCompressor("gzip")
+    body = compressor.compress(b'{"a": 1}\n') + compressor.compress(b'{"b": 2}\n') + compressor.finish()
+    assert gzip.decompress(body) == b'{"a": 1}\n{"b": 2}\n'
@@ -0,0 +1,92 @@
+import asyncio
+from contextlib import nullcontext
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+
+def make_request(client_host: str = "10.0.0.1", forwarded_for: str = None) -> Request:
+    headers = [(b"x-forwarded-for", forwarded_for.encode("latin-1"))] if forwarded_for else []
+    return Request({"type": "http", "method": "POST", "path": "/api/feedback", "headers": headers, "client": (client_host, 1234)})
+
+def feedback(email: str = "ana@example.com", message: str = "Adorei o app") -> server.FeedbackRequest:
+    return server.FeedbackRequest(name="Ana", email=email, message=message, rating=5)
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+    return now
+
+@pytest.fixture(autouse=True)
+def limiters(monkeypatch):
+    monkeypatch.setattr(server, "FEEDBACK_RATE_STORE", "memory")
+    monkeypatch.setattr(server, "feedback_limiters", {
+        "ip": server.SlidingWindowLimiter(3, 60),
+        "email": server.SlidingWindowLimiter(2, 60),
+    })
+    monkeypatch.setattr(server, "recent_feedback_hashes", server.TTLCache(maxsize=100, ttl=3600))
+
+def test_sliding_window_limits_and_recovers(clock):
+    limiter = server.SlidingWindowLimiter(2, 60)
+    for _ in range(2):
+        assert limiter.retry_after("k") == 0
+        limiter.add("k")
+    assert limiter.retry_after("k") == 61
+
+    clock[0] += 30
+    assert limiter.retry_after("k") == 31
+    clock[0] += 31
+    assert limiter.retry_after("k") == 0
+
+def test_sliding_window_keys_are_independent(clock):
+    limiter = server.SlidingWindowLimiter(1, 60)
+    limiter.add("a")
+    assert limiter.retry_after("a") > 0
+    assert limiter.retry_after("b") == 0
+
+def test_forwarded_for_is_ignored_by_default(monkeypatch):
+    monkeypatch.setattr(server, "TRUST_FORWARDED_FOR", False)
+    assert server.client_ip(make_request("10.0.0.1", "1.2.3.4")) == "10.0.0.1"
+
+def test_forwarded_for_uses_the_entry_added_by_the_trusted_proxy(monkeypatch):
+    monkeypatch.setattr(server, "TRUST_FORWARDED_FOR", True)
+    monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 1)
+    # The leftmost entry is whatever the caller sent
+    assert server.client_ip(make_request("10.0.0.1", "6.6.6.6, 1.2.3.4")) == "1.2.3.4"
+
+    monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 2)
+    assert server.client_ip(make_request("10.0.0.1", "6.6.6.6, 1.2.3.4, 172.16.0.9")) == "1.2.3.4"
+    assert server.client_ip(make_request("10.0.0.1", "1.2.3.4")) == "10.0.0.1"
+
+def test_spoofed_forwarded_for_does_not_bypass_the_ip_limit(monkeypatch, clock):
+    monkeypatch.setattr(server, "TRUST_FORWARDED_FOR", True)
+    monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 1)
+    for index in range(3):
+        request = make_request("10.0.0.1", f"9.9.9.{index}, 1.2.3.4")
+        asyncio.run(server.admit_feedback(request, feedback(f"user{index}@example.com", f"mensagem {index}")))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.admit_feedback(make_request("10.0.0.1", "9.9.9.99, 1.2.3.4"), feedback("x@example.com", "outra")))
+    assert error.value.status_code == 429
+    assert int(error.value.headers["Retry-After"]) > 0
+
+def test_email_limit(clock):
+    for index in range(2):
+        asyncio.run(server.admit_feedback(make_request(f"10.0.0.{index}"), feedback(message=f"mensagem {index}")))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.admit_feedback(make_request("10.0.0.9"), feedback(message="mais uma")))
+    assert error.value.status_code == 429
+
+def test_duplicate_message_is_rejected(clock):
+    asyncio.run(server.admit_feedback(make_request("10.0.0.1"), feedback(message="Adorei o app")))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.admit_feedback(make_request("10.0.0.2"), feedback(email="ANA@example.com", message="  adorei   o APP ")))
+    assert error.value.status_code == 409
+
+def test_rejected_requests_do_not_use_up_the_window(clock):
+    for index in range(3):
+        with pytest.raises(HTTPException) if index == 2 else nullcontext():
+            asyncio.run(server.admit_feedback(make_request("10.0.0.1"), feedback(message=f"mensagem {index}")))
+    assert len(server.feedback_limiters["email"].hits["email:ana@example.com"]) == 2
@@ -0,0 +1,138 @@
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+
+def sample_feedback(rating=None, message="Muito bom", name="Ana"):
+    return {
+        "id": f"{name}-{message}",
+        "name": name,
+        "email": f"{name.lower()}@example.com",
+        "message": message,
+        "rating": rating,
+        "created_at": datetime(2026, 3, 1, 12, 30, tzinfo=timezone.utc),
+    }
+
+def test_digest_only_when_enabled_and_not_a_low_rating(monkeypatch):
+    monkeypatch.setattr(server, "FEEDBACK_DIGEST_ENABLED", False)
+    assert not server.use_feedback_digest(5)
+
+    monkeypatch.setattr(server, "FEEDBACK_DIGEST_ENABLED", True)
+    monkeypatch.setattr(server, "FEEDBACK_IMMEDIATE_MAX_RATING", 2)
+    assert server.use_feedback_digest(5)
+    assert server.use_feedback_digest(3)
+    assert server.use_feedback_digest(None)
+    assert not server.use_feedback_digest(2)
+    assert not server.use_feedback_digest(1)
+
+def test_digest_message_summarises_ratings():
+    feedbacks = [
+        sample_feedback(5, "Ótimo", "Ana"),
+        sample_feedback(4, "Bom", "Bia"),
+        sample_feedback(None, "Sem nota", "Caio"),
+    ]
+    message = server.build_feedback_digest_message(feedbacks)
+    body = message.get_payload()[0].get_payload(decode=True).decode("utf-8")
+    assert message["Subject"] == "Resumo de feedback FitLife AI - 3 mensagens"
+    assert "média 4.5/5" in body
+    assert "(5): 1" in body
+    assert "(3): 0" in body
+    assert "Sem avaliação: 1" in body
+    for feedback in feedbacks:
+        assert feedback["message"] in body
+
+def matches(doc, query):
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(doc, option) for option in condition):
+                return False
+            continue
+        value = doc.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+        elif "$ne" in condition and value == condition["$ne"]:
+            return False
+        elif "$in" in condition and value not in condition["$in"]:
+            return False
+        elif "$lt" in condition and not (value is not None and value < condition["$lt"]):
+            return False
+        elif "$lte" in condition and not (value is not None and value <= condition["$lte"]):
+            return False
+    return True
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, field, direction=1):
+        self.docs = sorted(self.docs, key=lambda doc: doc[field], reverse=direction == -1)
+        return self
+
+    def limit(self, count):
+        self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length):
+        return [dict(doc) for doc in self.docs[:length]]
+
+class FakeFeedback:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection=None):
+        return FakeCursor([doc for doc in self.docs if matches(doc, query)])
+
+    async def find_one(self, query, projection=None):
+        return next((dict(doc) for doc in self.docs if matches(doc, query)), None)
+
+    async def find_one_and_update(self, query, update, **kwargs):
+        for doc in self.docs:
+            if matches(doc, query):
+                self.apply(doc, update)
+                return dict(doc)
+        return None
+
+    async def update_many(self, query, update):
+        for doc in [doc for doc in self.docs if matches(doc, query)]:
+            self.apply(doc, update)
+
+    @staticmethod
+    def apply(doc, update):
+        doc.update(update.get("$set", {}))
+        for field, amount in update.get("$inc", {}).items():
+            doc[field] = doc.get(field, 0) + amount
+
+class FakeDb:
+    def __init__(self, docs):
+        self.feedback = FakeFeedback(docs)
+
+def stale_digest_batch():
+    expired = datetime.now(timezone.utc) - timedelta(minutes=5)
+    return [
+        {**sample_feedback(5, f"mensagem {index}"), "digest": True, "status": "sending",
+         "batch_id": "crashed", "locked_until": expired, "attempts": 1, "next_attempt_at": expired}
+        for index in range(3)
+    ]
+
+@pytest.fixture
+def feedback_db(monkeypatch):
+    fake = FakeDb(stale_digest_batch())
+    monkeypatch.setattr(server, "db", fake)
+    return fake
+
+def test_single_sends_do_not_take_over_stale_digest_batches(feedback_db):
+    assert asyncio.run(server.claim_due_feedback()) is None
+    assert all(doc["status"] == "sending" and doc["batch_id"] == "crashed" for doc in feedback_db.feedback.docs)
+
+def test_stale_digest_batch_is_claimed_again_as_a_whole(feedback_db):
+    batch = asyncio.run(server.claim_feedback_digest())
+    assert len(batch) == 3
+    assert {doc["batch_id"] for doc in batch} != {"crashed"}
+    assert len({doc["batch_id"] for doc in batch}) == 1
+    assert all(doc["attempts"] == 2 and doc["locked_until"] > datetime.now(timezone.utc) for doc in batch)
+
+    # The new lease keeps other workers away until it expires
+    assert asyncio.run(server.claim_feedback_digest()) == []
@@ -0,0 +1,68 @@
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+
+class FakeFeedback:
+    def __init__(self):
+        self.updates = []
+
+    async def update_one(self, query, update):
+        self.updates.append((query, update))
+
+class FakeDb:
+    def __init__(self):
+        self.feedback = FakeFeedback()
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDb()
+    monkeypatch.setattr(server, "db", fake)
+    return fake
+
+def sample_feedback(rating=None, message="Muito bom", name="Ana"):
+    return {
+        "id": f"{name}-{message}",
+        "name": name,
+        "email": f"{name.lower()}@example.com",
+        "message": message,
+        "rating": rating,
+        "created_at": datetime(2026, 3, 1, 12, 30, tzinfo=timezone.utc),
+    }
+
+@pytest.mark.parametrize("attempts", [1, 2, 3])
+def test_failed_attempt_is_retried_with_exponential_backoff(db, monkeypatch, attempts):
+    monkeypatch.setattr(server, "FEEDBACK_MAX_ATTEMPTS", 5)
+    monkeypatch.setattr(server, "FEEDBACK_RETRY_BASE_SECONDS", 30)
+    before = datetime.now(timezone.utc)
+    asyncio.run(server.mark_feedback_failed_attempt({"id": "f1", "attempts": attempts}, RuntimeError("timeout")))
+
+    query, update = db.feedback.updates[0]
+    assert query == {"id": "f1"}
+    assert update["$set"]["status"] == "queued"
+    assert update["$set"]["last_error"] == "timeout"
+    delay = update["$set"]["next_attempt_at"] - before
+    assert timedelta(seconds=30 * 2 ** (attempts - 1)) <= delay < timedelta(seconds=30 * 2 ** (attempts - 1) + 5)
+
+def test_last_attempt_marks_feedback_failed(db, monkeypatch):
+    monkeypatch.setattr(server, "FEEDBACK_MAX_ATTEMPTS", 5)
+    asyncio.run(server.mark_feedback_failed_attempt({"id": "f1", "attempts": 5}, RuntimeError("refused")))
+    assert db.feedback.updates[0][1] == {"$set": {"status": "failed", "last_error": "refused"}}
+
+def test_feedback_message():
+    message = server.build_feedback_message(sample_feedback(rating=4))
+    body = message.get_payload()[0].get_payload(decode=True).decode("utf-8")
+    assert message["Subject"] == "Feedback FitLife AI - Ana"
+    assert message["To"] == server.FEEDBACK_EMAIL
+    assert "Muito bom" in body
+    assert "01/03/2026 às 12:30" in body
+
+def test_smtp_configured(monkeypatch):
+    monkeypatch.setattr(server, "SMTP_USERNAME", None)
+    monkeypatch.setattr(server, "SMTP_PASSWORD", None)
+    monkeypatch.setattr(server, "SMTP_NO_AUTH", False)
+    assert not server.smtp_configured()
+    monkeypatch.setattr(server, "SMTP_NO_AUTH", True)
+    assert server.smtp_configured()
@@ -0,0 +1,84 @@
+import asyncio
+
+import server
+
+PLAN = server.format_ai_response("""Olá Ana, aqui está seu plano.
+🔥 AQUECIMENTO (5-10 minutos)
+- Polichinelos 2 minutos
+💪 TREINO PRINCIPAL
+- Agachamento: 4x12, descanso 60s
+- Supino: 3x10
+🧘 ALONGAMENTO/RESFRIAMENTO
+- Alongamento de quadríceps
+💡 DICAS ESPECÍFICAS PARA O LOCAL:
+- Use halteres""")
+
+def titles(sections):
+    return [section.split("\n", 1)[0] for section in sections]
+
+def test_split_plan_sections():
+    sections = server.split_plan_sections(PLAN)
+    assert titles(sections) == [
+        "Olá Ana, aqui está seu plano.",
+        "🔥 AQUECIMENTO (5-10 minutos)",
+        "💪 TREINO PRINCIPAL",
+        "🧘 ALONGAMENTO/RESFRIAMENTO",
+        "💡 DICAS ESPECÍFICAS PARA O LOCAL:",
+    ]
+    assert "\n\n".join(sections) == PLAN
+
+def test_only_sections_mentioned_by_the_request_are_selected():
+    sections = server.split_plan_sections(PLAN)
+    assert server.select_followup_sections(sections, "troque o agachamento por leg press") == [2]
+
+def test_request_without_matches_selects_the_whole_plan():
+    sections = server.split_plan_sections(PLAN)
+    assert server.select_followup_sections(sections, "quero algo diferente") == list(range(len(sections)))
+
+def test_rewritten_sections_are_merged_by_title():
+    sections = server.split_plan_sections(PLAN)
+    response = server.format_ai_response("💪 TREINO PRINCIPAL\n- Leg press: 4x12, descanso 60s\n- Supino: 3x10")
+    merged = server.merge_followup_sections(sections, [2], response)
+    assert "Leg press" in merged
+    assert "Agachamento" not in merged
+    assert titles(server.split_plan_sections(merged)) == titles(sections)
+
+def test_answer_without_known_titles_replaces_the_selection():
+    sections = server.split_plan_sections(PLAN)
+    merged = server.merge_followup_sections(sections, [2], "- Leg press: 4x12")
+    assert "Agachamento" not in merged
+    assert merged.index("Polichinelos") < merged.index("Leg press") < merged.index("ALONGAMENTO")
+
+class FakeSuggestions:
+    def __init__(self, ids):
+        self.ids = set(ids)
+
+    async def find_one(self, query, projection=None):
+        return {"_id": 1} if query["id"] in self.ids else None
+
+def test_deleted_plan_is_forgotten(monkeypatch):
+    monkeypatch.setattr(server, "conversation_states", {})
+    server.remember_conversation("u1", "workout", "s1", PLAN)
+    server.forget_conversation("u1", "workout", ["other"])
+    assert ("u1", "workout") in server.conversation_states
+    server.forget_conversation("u1", "workout", ["s1"])
+    assert ("u1", "workout") not in server.conversation_states
+
+def test_cached_plan_is_not_used_once_removed_from_storage(monkeypatch):
+    monkeypatch.setattr(server, "conversation_states", {})
+    monkeypatch.setattr(server, "suggestion_source", lambda suggestion_type: (FakeSuggestions(stored), {}))
+    latest = []
+
+    async def find_suggestions(suggestion_type, user_id, limit=20):
+        return latest
+
+    monkeypatch.setattr(server, "find_suggestions", find_suggestions)
+    server.remember_conversation("u1", "workout", "s1", PLAN)
+
+    stored = {"s1"}
+    assert asyncio.run(server.load_conversation_plan("u1", "workout")) == PLAN
+
+    # Deleted on another instance: fall back to the newest stored plan
+    stored = set()
+    assert asyncio.run(server.load_conversation_plan("u1", "workout")) is None
+    assert ("u1", "workout") not in server.conversation_states
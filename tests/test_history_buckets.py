@@ -0,0 +1,61 @@
+import asyncio
+from datetime import datetime, timezone
+
+import server
+
+def created(day):
+    return datetime(2026, 3, day, tzinfo=timezone.utc)
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, *args):
+        return self
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for doc in self.docs:
+            yield doc
+
+class FakeBuckets:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.finds = []
+
+    def find(self, query, projection=None):
+        self.finds.append((query, projection))
+        return FakeCursor(self.buckets)
+
+class NoDocuments:
+    def find(self, *args, **kwargs):
+        raise AssertionError("summary lists must not read the suggestion documents")
+
+class FakeDb:
+    def __init__(self, buckets):
+        self.suggestion_buckets = buckets
+
+    def __getitem__(self, name):
+        return NoDocuments()
+
+def test_entries_are_summaries():
+    entry = server.bucket_entry({"id": "s1", "created_at": created(1), "suggestion": "💪 TREINO\n- Supino"})
+    assert entry == {"id": "s1", "created_at": created(1), "title": "💪 TREINO", "chars": 17}
+
+def test_bucket_layout_answers_summaries_from_the_buckets_alone(monkeypatch):
+    buckets = FakeBuckets([
+        {"entries": [{"id": "s3", "created_at": created(3), "title": "c", "chars": 1},
+                     {"id": "s2", "created_at": created(2), "title": "b", "chars": 1}]},
+        {"entries": [{"id": "s1", "created_at": created(1), "title": "a", "chars": 1}]},
+    ])
+    monkeypatch.setattr(server, "db", FakeDb(buckets))
+    monkeypatch.setattr(server, "SUGGESTIONS_STORAGE", "split")
+    monkeypatch.setattr(server, "suggestion_source", lambda suggestion_type: (NoDocuments(), {}))
+
+    summaries = asyncio.run(server.find_history_summaries("workout", "u1", limit=2, layout="buckets"))
+    assert [summary["id"] for summary in summaries] == ["s3", "s2"]
+    assert all(summary["type"] == "workout" for summary in summaries)
+    # The first bucket already holds enough entries
+    assert len(buckets.finds) == 1
@@ -0,0 +1,104 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+USER = server.User(id="u1", email="ana@example.com", name="Ana", age=30, weight=60, height=165, goals="Saúde")
+
+def created(day):
+    return datetime(2026, 3, day, tzinfo=timezone.utc)
+
+def suggestion(suggestion_id, day):
+    return {"id": suggestion_id, "user_id": "u1", "suggestion": f"plano {suggestion_id}", "created_at": created(day)}
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, *args):
+        return self
+
+    async def to_list(self, length):
+        return self.docs
+
+class FakeUsers:
+    def __init__(self, seq):
+        self.seq = seq
+
+    async def find_one(self, query, projection=None):
+        return {"history_seq": self.seq}
+
+class FakeChanges:
+    def __init__(self, changes):
+        self.changes = changes
+
+    def find(self, query, projection=None):
+        return FakeCursor([change for change in self.changes if change["seq"] > query["seq"]["$gt"]])
+
+class FakeDb:
+    def __init__(self, seq, changes):
+        self.users = FakeUsers(seq)
+        self.history_changes = FakeChanges(changes)
+
+@pytest.fixture
+def history(monkeypatch):
+    stored = {
+        # Many more recent workouts than nutrition plans
+        "workout": [suggestion(f"w{day}", day) for day in range(28, 3, -1)],
+        "nutrition": [suggestion("n1", 1)],
+    }
+
+    async def find_suggestions(suggestion_type, user_id, limit=20):
+        return stored[suggestion_type][:limit]
+
+    async def find_suggestions_by_ids(suggestion_type, user_id, suggestion_ids):
+        return [{**doc, "type": suggestion_type} for doc in stored[suggestion_type] if doc["id"] in suggestion_ids]
+
+    monkeypatch.setattr(server, "find_suggestions", find_suggestions)
+    monkeypatch.setattr(server, "find_suggestions_by_ids", find_suggestions_by_ids)
+    return stored
+
+def sync(monkeypatch, since, seq, changes=()):
+    monkeypatch.setattr(server, "db", FakeDb(seq, list(changes)))
+    response = asyncio.run(server.sync_history(since=since, current_user=USER))
+    return json.loads(response.body)
+
+def test_full_snapshot_has_the_latest_of_every_type(monkeypatch, history):
+    body = sync(monkeypatch, None, 7)
+    assert body["full"] is True
+    assert body["token"] == "7"
+    ids = [entry["id"] for entry in body["suggestions"]]
+    assert len([entry for entry in body["suggestions"] if entry["type"] == "workout"]) == 20
+    assert "n1" in ids
+    assert ids[0] == "w28"
+
+def test_up_to_date_token_returns_no_changes(monkeypatch, history):
+    body = sync(monkeypatch, "7", 7)
+    assert body == {"token": "7", "full": False, "suggestions": [], "deleted": []}
+
+def test_changes_keep_the_last_operation_per_suggestion(monkeypatch, history):
+    changes = [
+        {"seq": 6, "op": "upsert", "type": "workout", "id": "w28"},
+        {"seq": 7, "op": "upsert", "type": "nutrition", "id": "n9"},
+        {"seq": 8, "op": "delete", "type": "nutrition", "id": "n9"},
+    ]
+    body = sync(monkeypatch, "5", 8, changes)
+    assert body["full"] is False
+    assert body["token"] == "8"
+    assert [entry["id"] for entry in body["suggestions"]] == ["w28"]
+    assert body["deleted"] == [{"type": "nutrition", "id": "n9"}]
+
+@pytest.mark.parametrize("since, changes", [
+    # Change log entries already expired
+    ("2", [{"seq": 6, "op": "upsert", "type": "workout", "id": "w28"}]),
+    # Token from the future (e.g. another database)
+    ("9", []),
+    ("abc", []),
+])
+def test_incomplete_change_log_forces_a_full_resync(monkeypatch, history, since, changes):
+    body = sync(monkeypatch, since, 6, changes)
+    assert body["full"] is True
+    assert body["token"] == "6"
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+
+import server
+
+class FakeKeys:
+    def __init__(self):
+        self.docs = {}
+
+    async def insert_one(self, doc):
+        if doc["key"] in self.docs:
+            raise DuplicateKeyError("E11000 duplicate key")
+        self.docs[doc["key"]] = dict(doc)
+
+    async def find_one(self, query):
+        return self.docs.get(query["key"])
+
+    async def update_one(self, query, update):
+        self.docs[query["key"]].update(update["$set"])
+
+    async def delete_one(self, query):
+        doc = self.docs.get(query["key"])
+        if doc and doc["status"] == query["status"]:
+            del self.docs[query["key"]]
+
+class FakeDb:
+    def __init__(self):
+        self.idempotency_keys = FakeKeys()
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDb()
+    monkeypatch.setattr(server, "db", fake)
+    monkeypatch.setattr(server, "idempotency_cache", server.TTLCache(maxsize=100, ttl=3600))
+    monkeypatch.setattr(server, "idempotency_inflight", {})
+    return fake
+
+def counting_producer(calls, delay=0.0):
+    async def producer():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return {"id": f"s{len(calls)}"}
+    return producer
+
+def test_requests_without_a_key_always_run(db):
+    calls = []
+    for _ in range(2):
+        asyncio.run(server.run_idempotent(None, "suggestions/workout", "u1", counting_producer(calls)))
+    assert len(calls) == 2
+    assert db.idempotency_keys.docs == {}
+
+def test_replay_returns_the_stored_response(db):
+    calls = []
+    first = asyncio.run(server.run_idempotent("k1", "suggestions/workout", "u1", counting_producer(calls)))
+    second = asyncio.run(server.run_idempotent("k1", "suggestions/workout", "u1", counting_producer(calls)))
+    assert first == second == {"id": "s1"}
+    assert len(calls) == 1
+    assert db.idempotency_keys.docs["suggestions/workout:u1:k1"]["status"] == "completed"
+
+def test_replay_on_another_instance_reads_mongo(db, monkeypatch):
+    calls = []
+    asyncio.run(server.run_idempotent("k1", "suggestions/workout", "u1", counting_producer(calls)))
+    monkeypatch.setattr(server, "idempotency_cache", server.TTLCache(maxsize=100, ttl=3600))
+    assert asyncio.run(server.run_idempotent("k1", "suggestions/workout", "u1", counting_producer(calls))) == {"id": "s1"}
+    assert len(calls) == 1
+
+def test_keys_are_scoped_per_user_and_endpoint(db):
+    calls = []
+    asyncio.run(server.run_idempotent("k1", "suggestions/workout", "u1", counting_producer(calls)))
+    asyncio.run(server.run_idempotent("k1", "suggestions/workout", "u2", counting_producer(calls)))
+    asyncio.run(server.run_idempotent("k1", "suggestions/nutrition", "u1", counting_producer(calls)))
+    assert len(calls) == 3
+
+def test_concurrent_replays_wait_for_the_original(db):
+    calls = []
+
+    async def both():
+        return await asyncio.gather(
+            server.run_idempotent("k1", "suggestions/workout", "u1", counting_producer(calls, delay=0.01)),
+            server.run_idempotent("k1", "suggestions/workout", "u1", counting_producer(calls, delay=0.01)),
+        )
+
+    assert asyncio.run(both()) == [{"id": "s1"}, {"id": "s1"}]
+    assert len(calls) == 1
+
+def test_key_still_processing_elsewhere_is_a_conflict(db):
+    db.idempotency_keys.docs["suggestions/workout:u1:k1"] = {"key": "suggestions/workout:u1:k1", "status": "processing"}
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.run_idempotent("k1", "suggestions/workout", "u1", counting_producer([])))
+    assert error.value.status_code == 409
+
+def test_failed_request_releases_the_key(db):
+    async def failing():
+        raise RuntimeError("LLM unavailable")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.run_idempotent("k1", "suggestions/workout", "u1", failing))
+    assert db.idempotency_keys.docs == {}
+    assert asyncio.run(server.run_idempotent("k1", "suggestions/workout", "u1", counting_producer([]))) == {"id": "s1"}
+
+def test_key_length_is_limited(db):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.run_idempotent("k" * 256, "suggestions/workout", "u1", counting_producer([])))
+    assert error.value.status_code == 400
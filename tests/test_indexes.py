@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+import server
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs[:length]
+
+class FakeCollection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.created = []
+
+    async def create_index(self, keys, **options):
+        error = self.database.errors.get((self.name, str(keys)))
+        if error:
+            raise error
+        self.created.append(keys)
+
+    def aggregate(self, pipeline):
+        return FakeCursor(self.database.duplicates.get(self.name, []))
+
+class FakeDb:
+    def __init__(self, errors=None, duplicates=None):
+        self.errors = errors or {}
+        self.duplicates = duplicates or {}
+        self.collections = {}
+        self.commands = []
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection(self, name))
+
+    def __getattr__(self, name):
+        return self[name]
+
+    async def command(self, name, value, **kwargs):
+        self.commands.append((name, value, kwargs))
+
+def test_all_indexes_are_created(monkeypatch):
+    fake = FakeDb()
+    monkeypatch.setattr(server, "db", fake)
+    asyncio.run(server.create_indexes())
+    assert "email" in fake.users.created
+    assert [("user_id", 1), ("seq", 1)] in fake.history_changes.created
+
+def test_optional_index_failure_does_not_skip_the_others(monkeypatch):
+    fake = FakeDb(errors={("feedback", "created_at"): OperationFailure("boom", code=1)})
+    monkeypatch.setattr(server, "db", fake)
+    asyncio.run(server.create_indexes())
+    assert [("status", 1), ("next_attempt_at", 1)] in fake.feedback.created
+    assert "event_id" in fake.stripe_events.created
+
+def test_ttl_change_uses_coll_mod(monkeypatch):
+    fake = FakeDb(errors={("llm_generations", "created_at"): OperationFailure("different options", code=server.INDEX_OPTIONS_CONFLICT)})
+    monkeypatch.setattr(server, "db", fake)
+    asyncio.run(server.create_indexes())
+    expire = server.LLM_GENERATIONS_TTL_DAYS * 86400
+    assert ("collMod", "llm_generations", {"index": {"keyPattern": {"created_at": 1}, "expireAfterSeconds": expire}}) in fake.commands
+
+def test_duplicate_emails_are_reported_and_stop_startup(monkeypatch, caplog):
+    fake = FakeDb(
+        errors={("users", "email"): DuplicateKeyError("E11000 duplicate key", code=server.DUPLICATE_KEY)},
+        duplicates={"users": [{"_id": "ana@example.com", "count": 2}]},
+    )
+    monkeypatch.setattr(server, "db", fake)
+    with pytest.raises(RuntimeError, match=r"users\(email\)"):
+        asyncio.run(server.create_indexes())
+    assert "'ana@example.com' x2" in caplog.text
+    # The indexes after it are still built
+    assert "key" in fake.idempotency_keys.created
+    assert "event_id" in fake.stripe_events.created
+    assert [("user_id", 1), ("seq", 1)] in fake.history_changes.created
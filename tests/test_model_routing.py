@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+import server
+
+ROUTES = {
+    "standard": {"model": ["gemini", "primary"], "fallback": ["gemini", "fallback"], "latency_slo_ms": 1000},
+    "single": {"model": ["gemini", "only"], "latency_slo_ms": 1000},
+}
+PRIMARY = ("gemini", "primary")
+FALLBACK = ("gemini", "fallback")
+
+@pytest.fixture(autouse=True)
+def routes(monkeypatch):
+    monkeypatch.setattr(server, "MODEL_ROUTES", ROUTES)
+    monkeypatch.setattr(server, "route_stats", {})
+    monkeypatch.setattr(server.random, "random", lambda: 0.99)
+
+def primary_stats(latencies):
+    stats = server.route_stats.setdefault("standard:primary", server.RouteStats())
+    for latency in latencies:
+        stats.add_latency(latency)
+    return stats
+
+def test_primary_first_without_stats():
+    assert server.route_models("standard") == [PRIMARY, FALLBACK]
+
+def test_route_without_fallback():
+    assert server.route_models("single") == [("gemini", "only")]
+
+def test_slo_breach_prefers_fallback():
+    primary_stats([5000] * 10)
+    assert server.route_models("standard") == [FALLBACK, PRIMARY]
+
+def test_slo_breach_still_probes_primary(monkeypatch):
+    primary_stats([5000] * 10)
+    monkeypatch.setattr(server.random, "random", lambda: 0.0)
+    assert server.route_models("standard") == [PRIMARY, FALLBACK]
+
+def test_slo_breach_clears_once_old_latencies_leave_the_window(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: clock[0])
+    primary_stats([5000] * 10)
+    assert server.route_models("standard") == [FALLBACK, PRIMARY]
+
+    clock[0] += server.LLM_STATS_WINDOW_SECONDS + 1
+    primary_stats([100] * 5)
+    assert server.route_models("standard") == [PRIMARY, FALLBACK]
+
+def test_breaker_opens_after_consecutive_errors_and_closes_after_cooldown(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: clock[0])
+    stats = primary_stats([])
+    for _ in range(server.LLM_BREAKER_FAILURES):
+        stats.add_error()
+    assert stats.breaker_open()
+    assert server.route_models("standard") == [FALLBACK, PRIMARY]
+
+    clock[0] += server.LLM_BREAKER_COOLDOWN_SECONDS + 1
+    assert not stats.breaker_open()
+    assert server.route_models("standard") == [PRIMARY, FALLBACK]
+
+def test_success_resets_consecutive_errors():
+    stats = primary_stats([])
+    for _ in range(server.LLM_BREAKER_FAILURES - 1):
+        stats.add_error()
+    stats.add_latency(100)
+    stats.add_error()
+    assert not stats.breaker_open()
+
+def test_queue_wait_is_not_counted_as_model_latency(monkeypatch):
+    clock = [0.0]
+    recorded = []
+
+    class FakeChat:
+        def __init__(self, **kwargs):
+            pass
+
+        def with_model(self, provider, model):
+            return self
+
+        async def send_message(self, message):
+            clock[0] += 0.2
+            return "ok"
+
+    class SlowSemaphore:
+        async def __aenter__(self):
+            clock[0] += 5.0
+
+        async def __aexit__(self, *args):
+            return False
+
+    async def record_generation(route, model, latency_ms, *args, queue_ms=0.0, **kwargs):
+        recorded.append((latency_ms, queue_ms))
+
+    monkeypatch.setenv("EMERGENT_LLM_KEY", "test")
+    monkeypatch.setattr(server, "LlmChat", FakeChat)
+    monkeypatch.setattr(server, "llm_semaphore", SlowSemaphore())
+    monkeypatch.setattr(server, "record_generation", record_generation)
+    monkeypatch.setattr(server.time, "perf_counter", lambda: clock[0])
+
+    async def send():
+        await server.send_llm_message("s1", "system", "oi", route="single")
+        await asyncio.gather(*server.background_tasks)
+
+    asyncio.run(send())
+    latency_ms, queue_ms = recorded[0]
+    assert latency_ms == pytest.approx(200)
+    assert queue_ms == pytest.approx(5000)
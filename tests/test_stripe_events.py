@@ -0,0 +1,130 @@
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+
+def matches(doc, query):
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(doc, option) for option in condition):
+                return False
+            continue
+        value = doc.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+        elif "$lt" in condition and not (value is not None and value < condition["$lt"]):
+            return False
+        elif "$lte" in condition and not (value is not None and value <= condition["$lte"]):
+            return False
+    return True
+
+class FakeCollection:
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+
+    async def find_one(self, query, projection=None):
+        return next((dict(doc) for doc in self.docs if matches(doc, query)), None)
+
+    async def find_one_and_update(self, query, update, sort=None, **kwargs):
+        candidates = [doc for doc in self.docs if matches(doc, query)]
+        for field, direction in reversed(sort or []):
+            candidates.sort(key=lambda doc: doc[field], reverse=direction == -1)
+        if not candidates:
+            return None
+        await self.update_one({"event_id": candidates[0]["event_id"]}, update)
+        return dict(candidates[0])
+
+    async def update_one(self, query, update):
+        for doc in self.docs:
+            if matches(doc, query):
+                doc.update(update.get("$set", {}))
+                for field, amount in update.get("$inc", {}).items():
+                    doc[field] = doc.get(field, 0) + amount
+                return
+
+class FakeDb:
+    def __init__(self, events, transactions=()):
+        self.stripe_events = FakeCollection(events)
+        self.payment_transactions = FakeCollection(transactions)
+
+NOW = datetime.now(timezone.utc)
+
+def event(event_id, seconds_ago, event_type="checkout.session.completed", payment_status="paid", **fields):
+    return {
+        "event_id": event_id,
+        "event_type": event_type,
+        "session_id": "cs_1",
+        "payment_status": payment_status,
+        "metadata": {"user_id": "u1"},
+        "status": "pending",
+        "attempts": 0,
+        "received_at": NOW - timedelta(seconds=seconds_ago),
+        "next_attempt_at": NOW - timedelta(seconds=seconds_ago),
+        **fields,
+    }
+
+def by_id(fake, event_id):
+    return next(doc for doc in fake.stripe_events.docs if doc["event_id"] == event_id)
+
+@pytest.fixture
+def applied(monkeypatch):
+    applied = []
+
+    async def apply_stripe_event(event):
+        if event["event_id"].startswith("bad"):
+            raise RuntimeError("database unavailable")
+        applied.append(event["event_id"])
+
+    monkeypatch.setattr(server, "apply_stripe_event", apply_stripe_event)
+    monkeypatch.setattr(server, "STRIPE_EVENT_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(server, "STRIPE_EVENT_RETRY_BASE_SECONDS", 10)
+    return applied
+
+def test_events_are_applied_in_the_order_stripe_sent_them(monkeypatch, applied):
+    fake = FakeDb([event("evt_3", 10), event("evt_1", 30), event("evt_2", 20)])
+    monkeypatch.setattr(server, "db", fake)
+    assert asyncio.run(server.process_stripe_events()) == 3
+    assert applied == ["evt_1", "evt_2", "evt_3"]
+    assert all(doc["status"] == "applied" for doc in fake.stripe_events.docs)
+
+def test_failed_event_is_retried_with_backoff(monkeypatch, applied):
+    fake = FakeDb([event("bad_1", 30, attempts=1), event("evt_2", 20)])
+    monkeypatch.setattr(server, "db", fake)
+    assert asyncio.run(server.process_stripe_events()) == 1
+
+    failed = by_id(fake, "bad_1")
+    assert failed["status"] == "pending"
+    assert failed["attempts"] == 2
+    assert failed["last_error"] == "database unavailable"
+    delay = failed["next_attempt_at"] - datetime.now(timezone.utc)
+    assert timedelta(seconds=15) < delay <= timedelta(seconds=20)
+
+def test_event_fails_after_the_last_attempt(monkeypatch, applied):
+    fake = FakeDb([event("bad_1", 30, attempts=2)])
+    monkeypatch.setattr(server, "db", fake)
+    asyncio.run(server.process_stripe_events())
+    assert by_id(fake, "bad_1")["status"] == "failed"
+
+def test_event_left_processing_by_a_crashed_worker_is_claimed_again(monkeypatch, applied):
+    stale = event("evt_1", 30, status="processing", attempts=1, locked_until=NOW - timedelta(seconds=1))
+    leased = event("evt_2", 20, status="processing", attempts=1, locked_until=NOW + timedelta(minutes=1))
+    fake = FakeDb([stale, leased])
+    monkeypatch.setattr(server, "db", fake)
+    asyncio.run(server.process_stripe_events())
+    assert applied == ["evt_1"]
+    assert by_id(fake, "evt_2")["status"] == "processing"
+
+def test_completed_transaction_is_not_changed_by_a_late_expiry(monkeypatch):
+    fake = FakeDb([], [{"session_id": "cs_1", "user_id": "u1", "payment_status": "completed"}])
+    monkeypatch.setattr(server, "db", fake)
+    asyncio.run(server.apply_stripe_event(event("evt_1", 0, "checkout.session.expired", "unpaid")))
+    assert fake.payment_transactions.docs[0]["payment_status"] == "completed"
+
+def test_expiry_marks_a_pending_transaction_expired(monkeypatch):
+    fake = FakeDb([], [{"session_id": "cs_1", "user_id": "u1", "payment_status": "pending"}])
+    monkeypatch.setattr(server, "db", fake)
+    asyncio.run(server.apply_stripe_event(event("evt_1", 0, "checkout.session.expired", "unpaid")))
+    assert fake.payment_transactions.docs[0]["payment_status"] == "expired"
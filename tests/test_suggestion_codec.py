@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import server
+
+TEXT = "💪 TREINO PRINCIPAL\n\nAgachamento livre: 4 séries x 12 repetições, descanso de 60 segundos."
+
+class FakeDictionaries:
+    def __init__(self, stored):
+        self.stored = stored
+        self.lookups = 0
+
+    async def find_one(self, query, projection=None, **kwargs):
+        self.lookups += 1
+        return self.stored.get(query.get("dict_id"))
+
+class FakeDb:
+    def __init__(self, codec_dictionaries):
+        self.codec_dictionaries = codec_dictionaries
+
+@pytest.fixture(autouse=True)
+def dictionaries(monkeypatch):
+    monkeypatch.setattr(server, "zstd_dictionaries", {})
+
+def roundtrip(monkeypatch, codec):
+    monkeypatch.setattr(server, "SUGGESTION_CODEC", codec)
+    doc = {"id": "s1", "user_id": "u1", "suggestion": TEXT}
+    encoded = server.encode_suggestion_doc(doc)
+    return encoded, asyncio.run(server.decode_suggestion_doc(encoded))
+
+def test_plain_documents_are_untouched(monkeypatch):
+    encoded, decoded = roundtrip(monkeypatch, "none")
+    assert encoded["suggestion"] == TEXT
+    assert decoded == encoded
+
+def test_zlib_roundtrip(monkeypatch):
+    encoded, decoded = roundtrip(monkeypatch, "zlib")
+    assert encoded["codec"] == "zlib"
+    assert decoded == {"id": "s1", "user_id": "u1", "suggestion": TEXT}
+
+def test_zstd_roundtrip_without_dictionary(monkeypatch):
+    pytest.importorskip("zstandard")
+    encoded, decoded = roundtrip(monkeypatch, "zstd")
+    assert encoded["codec"] == "zstd:0"
+    assert decoded["suggestion"] == TEXT
+
+def test_unknown_codec_is_rejected():
+    with pytest.raises(ValueError):
+        asyncio.run(server.decode_suggestion_doc({"suggestion": b"", "codec": "lz4"}))
+
+def test_unknown_zstd_dictionary_is_loaded_on_demand(monkeypatch):
+    zstandard = pytest.importorskip("zstandard")
+    samples = [f"{TEXT} {index} supino {index % 7}x10 descanso {index % 5}0s".encode("utf-8") for index in range(300)]
+    trained = zstandard.train_dictionary(4096, samples)
+    monkeypatch.setattr(server, "SUGGESTION_CODEC", "zstd")
+    server.zstd_dictionaries[7] = trained
+    encoded = server.encode_suggestion_doc({"id": "s1", "suggestion": TEXT})
+    assert encoded["codec"] == "zstd:7"
+
+    # Another instance trained dictionary 7; this one has never loaded it
+    server.zstd_dictionaries.clear()
+    fake = FakeDictionaries({7: {"dict_id": 7, "data": trained.as_bytes()}})
+    monkeypatch.setattr(server, "db", FakeDb(fake))
+    assert asyncio.run(server.decode_suggestion_doc(encoded))["suggestion"] == TEXT
+    assert asyncio.run(server.decode_suggestion_doc(encoded))["suggestion"] == TEXT
+    assert fake.lookups == 1
+
+def test_missing_zstd_dictionary_raises(monkeypatch):
+    pytest.importorskip("zstandard")
+    monkeypatch.setattr(server, "db", FakeDb(FakeDictionaries({})))
+    with pytest.raises(ValueError):
+        asyncio.run(server.decode_suggestion_doc({"suggestion": b"", "codec": "zstd:9"}))
+
+def test_unavailable_codec_is_reported(monkeypatch, caplog):
+    monkeypatch.setattr(server, "SUGGESTION_CODEC", "lz4")
+    server.check_suggestion_codec()
+    assert "Unknown SUGGESTION_CODEC 'lz4'" in caplog.text
+
+    caplog.clear()
+    monkeypatch.setattr(server, "SUGGESTION_CODEC", "zstd")
+    monkeypatch.setattr(server, "zstandard", None)
+    server.check_suggestion_codec()
+    assert "zstandard is not installed" in caplog.text
+    assert server.current_codec() is None